@@ -24,4 +24,6 @@ def remaining_wait_seconds(last_user_msg_at: datetime | None, now: datetime, min
 def is_allowed(last_user_msg_at: datetime | None, now: datetime, min_gap_seconds: int) -> bool:
     """Return True if user may send next message now."""
 
+    if last_user_msg_at is None:
+        return True
     return remaining_wait_seconds(last_user_msg_at, now, min_gap_seconds) == 0
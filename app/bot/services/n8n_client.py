@@ -50,6 +50,20 @@ async def call_n8n(req: N8nRequest, *, trace_id: str | None = None) -> N8nRespon
     Raises httpx.HTTPError on network errors.
     """
 
+    return await _post_json(req.model_dump(mode="json"), req.intent, trace_id=trace_id)
+
+
+async def call_n8n_raw(payload: dict, *, trace_id: str | None = None) -> N8nResponse:
+    """Same as call_n8n for an already serialized request payload.
+
+    Skips model construction/validation: the caller is responsible for the
+    payload matching N8nRequest (e.g. derived from a model_dump(mode="json")).
+    """
+
+    return await _post_json(payload, payload["intent"], trace_id=trace_id)
+
+
+async def _post_json(payload: dict, intent: str, *, trace_id: str | None = None) -> N8nResponse:
     settings = get_settings()
     headers = {"Content-Type": "application/json", "Accept": "application/json"}
     if trace_id:
@@ -59,9 +73,8 @@ async def call_n8n(req: N8nRequest, *, trace_id: str | None = None) -> N8nRespon
         else:
             get_logger().warning("skip_trace_id_non_ascii")
 
-    payload = req.model_dump(mode="json")
     start = perf_counter()
-    logger = get_logger().bind(intent=req.intent)
+    logger = get_logger().bind(intent=intent)
     try:
         async with _client() as client:
             logger.info("n8n_request_start", url=str(settings.n8n_webhook_url))
@@ -117,4 +130,4 @@ async def call_n8n(req: N8nRequest, *, trace_id: str | None = None) -> N8nRespon
             return n8n_resp
     finally:
         elapsed = perf_counter() - start
-        metrics.observe("n8n_request_seconds", elapsed, labels={"intent": req.intent})
+        metrics.observe("n8n_request_seconds", elapsed, labels={"intent": intent})
@@ -197,6 +197,8 @@ async def process_due_chats(session: AsyncSession, bot: Bot, settings: Settings)
         ctx = Context(history=history, last_user_msg_at=state.last_user_msg_at, last_assistant_at=state.last_assistant_at)
         chat_info = ChatInfo(chat_id=chat_id, user_id=None, persona=persona, memory_rev=state.memory_rev)
         req = N8nRequest(intent=intent, chat=chat_info, context=ctx)
+        # Последовательно, не через concurrent_map: advisory xact-lock чата держится до его commit ниже,
+        # а commit одного чата при параллельном fan-out снял бы локи всех остальных до записи их отметок
         try:
             resp = await call_n8n(req)
         except Exception:
@@ -136,12 +136,15 @@ async def flush_expired_pending_input(
     chat_id: int,
     settings: Settings,
     trace_id: str | None = None,
+    state: ChatState | None = None,
 ) -> bool:
     """Проверяет дедлайны буфера и делает flush ТОЛЬКО если они истекли.
 
     Возвращает True если был выполнен flush, иначе False.
+    state — уже загруженный вызывающим ChatState (чтобы не перечитывать).
     """
-    state = await session.get(ChatState, chat_id)
+    if state is None:
+        state = await session.get(ChatState, chat_id)
     if not state or not getattr(state, 'pending_input_json', None):
         return False
     payload = state.pending_input_json or {}
@@ -175,6 +178,7 @@ async def buffer_or_process(
     media: dict | None,
     settings: Settings,
     trace_id: Optional[str] = None,
+    state: ChatState | None = None,
 ) -> str:
     """Агрегирует серию сообщений пользователя (фото + последующие тексты) в одно.
 
@@ -186,9 +190,12 @@ async def buffer_or_process(
     - Сохраняем первое фото (media.origin=='photo') как media; последующие текстовые добавляем в aggregated text.
     - Для фото без caption text может быть пустым; caption добавляем как часть текста.
     - Не вставляем placeholder [photo] в сам текст; media несёт origin=photo.
+
+    state — уже загруженный вызывающим ChatState (чтобы не перечитывать).
     """
     now = utcnow()
-    state = await session.get(ChatState, chat_id)
+    if state is None:
+        state = await session.get(ChatState, chat_id)
     if state is None:
         # ensure_entities внутри process_user_text создаст state, но нам нужен сразу
         await ensure_entities(
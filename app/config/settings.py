@@ -111,6 +111,7 @@ class Settings(BaseSettings):
 
     # Limits
     max_user_text_len: int = 4000
+    max_upload_bytes: int = 20 * 1024 * 1024  # медиа больше не скачиваем и не грузим на /upload
 
     @field_validator("log_level")
     @classmethod
@@ -3,8 +3,9 @@ from __future__ import annotations
 """Database engine and async session factory."""
 
 from contextlib import asynccontextmanager
-from typing import AsyncIterator
+from typing import Any, AsyncIterator
 
+import orjson
 from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
 
 from app.config.settings import get_settings
@@ -12,10 +13,19 @@ from app.config.settings import get_settings
 
 settings = get_settings()
 
+
+def _orjson_serializer(value: Any) -> str:
+    """JSON/JSONB bind serializer: orjson instead of stdlib json (same output for our payloads)."""
+
+    return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS).decode()
+
+
 engine: AsyncEngine = create_async_engine(
     str(settings.db_dsn),
     future=True,
     pool_pre_ping=True,
+    json_serializer=_orjson_serializer,
+    json_deserializer=orjson.loads,
 )
 
 AsyncSessionFactory = async_sessionmaker(
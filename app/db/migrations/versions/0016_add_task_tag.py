@@ -0,0 +1,31 @@
+"""add tag to tasks
+
+Revision ID: 0016_add_task_tag
+Revises: 0015_merge_heads
+Create Date: 2025-09-21
+"""
+from __future__ import annotations
+
+import sqlalchemy as sa
+from alembic import op
+
+revision = '0016_add_task_tag'
+down_revision = '0015_merge_heads'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('tasks', sa.Column('tag', sa.String(length=64), nullable=True))
+    # varchar_pattern_ops — чтобы фильтр tag LIKE 'prefix%' мог использовать индекс
+    op.create_index(
+        'ix_tasks_tag_priority_created',
+        'tasks',
+        ['tag', 'priority', 'created_at'],
+        postgresql_ops={'tag': 'varchar_pattern_ops'},
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_tasks_tag_priority_created', table_name='tasks')
+    op.drop_column('tasks', 'tag')
@@ -147,6 +147,7 @@ class Task(Base):
     attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default="0")
     last_error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
     dedup_key: Mapped[Optional[str]] = mapped_column(String(128), nullable=True, unique=True)
+    tag: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)  # e.g. chat:<id>; фильтр воркеров по префиксу
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), nullable=False)
     updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)
     started_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
@@ -156,5 +157,6 @@ class Task(Base):
 
     __table_args__ = (
         Index("ix_tasks_status_priority_created", "status", "priority", "created_at"),
+        Index("ix_tasks_tag_priority_created", "tag", "priority", "created_at", postgresql_ops={"tag": "varchar_pattern_ops"}),
         CheckConstraint("status IN ('pending','processing','done','failed','cancelled')", name="ck_tasks_status"),
     )
@@ -3,9 +3,12 @@ from __future__ import annotations
 """Примитивная очередь задач на базе таблицы tasks.
 
 Функции:
-  enqueue_task(kind, payload, priority=100, dedup_key=None)
-  lease_tasks(kinds, limit, lease_seconds)
+  enqueue_task(kind, payload, priority=100, dedup_key=None, tag=None)
+  enqueue_tasks(kind, items, priority=100, tag=None)
+  lease_tasks(kinds, limit, lease_seconds, tag_prefix=None)
   heartbeat(task_id, lease_seconds)
+  new_task_listener(wake) — LISTEN на канал новых задач с переподпиской при обрыве
+  notify_new_tasks(session) — NOTIFY (enqueue_*, return_to_pending, watchdog)
   complete(task_id, status, error=None)
 
 Ограничения/допущения (v1):
@@ -14,14 +17,24 @@ from __future__ import annotations
   - Поведение идемпотентности через dedup_key (уникальное поле).
 """
 
+import asyncio
+import contextlib
+from contextlib import asynccontextmanager
 from datetime import timedelta
-from typing import Any, Iterable, Sequence
-from sqlalchemy import select, update
+from typing import Any, AsyncIterator, Iterable, Sequence
+from sqlalchemy import String, bindparam, select, text, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.sql.elements import BindParameter
 
+from app.db.base import engine
 from app.db.models import Task
 from app.utils.time import utcnow
 
+# Канал LISTEN/NOTIFY: Postgres доставит уведомление слушателям при коммите транзакции с задачей
+TASKS_CHANNEL = "tasks_new"
+_NOTIFY_SQL = text(f"NOTIFY {TASKS_CHANNEL}")
+
 
 async def enqueue_task(
     session: AsyncSession,
@@ -30,33 +43,172 @@ async def enqueue_task(
     payload: dict[str, Any] | None = None,
     priority: int = 100,
     dedup_key: str | None = None,
+    tag: str | None = None,
 ) -> Task:
     t = Task(
         kind=kind,
         payload_json=payload or {},
         priority=priority,
         dedup_key=dedup_key,
+        tag=tag,
     )
     session.add(t)
+    await notify_new_tasks(session)
     return t
 
 
+async def enqueue_tasks(
+    session: AsyncSession,
+    *,
+    kind: str,
+    items: Iterable[tuple[dict[str, Any], str | None]],
+    priority: int = 100,
+    tag: str | None = None,
+) -> None:
+    """Пакетная постановка (payload, dedup_key) одним INSERT.
+
+    Дубликаты по dedup_key молча пропускаются (ON CONFLICT DO NOTHING), а не валят транзакцию.
+    """
+    rows = [
+        {"kind": kind, "payload_json": payload or {}, "priority": priority, "dedup_key": dedup_key, "tag": tag}
+        for payload, dedup_key in items
+    ]
+    if not rows:
+        return
+    await session.execute(pg_insert(Task).values(rows).on_conflict_do_nothing(index_elements=[Task.dedup_key]))
+    await notify_new_tasks(session)
+
+
+async def notify_new_tasks(session: AsyncSession) -> None:
+    """NOTIFY слушателям TASKS_CHANNEL; доставится при коммите транзакции session."""
+    await session.execute(_NOTIFY_SQL)
+
+
+@asynccontextmanager
+async def new_task_listener(
+    wake: asyncio.Event,
+    *,
+    retry_seconds: float = 5.0,
+    health_seconds: float = 30.0,
+) -> AsyncIterator[bool]:
+    """Держит отдельное соединение с LISTEN на TASKS_CHANNEL и выставляет wake на каждый NOTIFY.
+
+    Подписка восстанавливается сама: при закрытии соединения (termination listener asyncpg) или
+    неудачном health-пинге раз в health_seconds фоновая задача переподключается с паузой
+    retry_seconds и будит wake, чтобы подобрать задачи, пропущенные без подписки.
+    Отдаёт True, если подписка активна на входе; False — драйвер не asyncpg (переподключения нет,
+    вызывающий остаётся на периодическом опросе) или первое подключение не удалось (будет повтор).
+    """
+    lost = asyncio.Event()
+    current: dict[str, Any] = {}
+
+    def _on_notify(*_: Any) -> None:
+        wake.set()
+
+    def _on_terminate(*_: Any) -> None:
+        lost.set()
+
+    async def _drop() -> None:
+        conn = current.pop("conn", None)
+        driver = current.pop("driver", None)
+        if driver is not None and not driver.is_closed():
+            with contextlib.suppress(Exception):
+                await driver.remove_listener(TASKS_CHANNEL, _on_notify)
+            with contextlib.suppress(Exception):
+                await conn.close()
+        elif conn is not None:
+            # мёртвое соединение не возвращаем в пул
+            with contextlib.suppress(Exception):
+                await conn.invalidate()
+
+    async def _subscribe() -> bool | None:
+        """True — подписаны; False — ошибка подключения; None — драйвер без LISTEN."""
+        try:
+            conn = await engine.connect()
+        except Exception:
+            return False
+        current["conn"] = conn
+        try:
+            driver = (await conn.get_raw_connection()).driver_connection
+            if not hasattr(driver, "add_listener"):
+                await _drop()
+                return None
+            current["driver"] = driver
+            await driver.add_listener(TASKS_CHANNEL, _on_notify)
+            driver.add_termination_listener(_on_terminate)
+        except Exception:
+            await _drop()
+            return False
+        return True
+
+    async def _supervise() -> None:
+        while True:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(lost.wait(), timeout=health_seconds)
+            if not lost.is_set():
+                driver = current.get("driver")
+                try:
+                    if driver is None or driver.is_closed():
+                        raise ConnectionError("listener connection closed")
+                    # SELECT 1 ловит и полуоткрытый TCP, о котором termination listener не узнает
+                    await asyncio.wait_for(driver.fetchval("SELECT 1"), timeout=retry_seconds)
+                    continue
+                except Exception:
+                    pass
+            lost.clear()
+            await _drop()
+            while await _subscribe() is not True:
+                await asyncio.sleep(retry_seconds)
+            # Пока подписки не было, NOTIFY могли пропасть — один внеочередной проход воркера
+            wake.set()
+
+    status = await _subscribe()
+    supervisor: asyncio.Task | None = None
+    if status is not None:
+        if status is False:
+            lost.set()
+        supervisor = asyncio.create_task(_supervise(), name="task_listener_supervisor")
+    try:
+        yield status is True
+    finally:
+        if supervisor is not None:
+            supervisor.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await supervisor
+        await _drop()
+
+
+def _tag_prefix_pattern(prefix: str) -> BindParameter[str]:
+    """LIKE-шаблон '<prefix>%' константой в тексте запроса.
+
+    startswith() строит шаблон выражением от параметра ($1 || '%'), и по нему планировщик
+    (в т.ч. generic-план закэшированного asyncpg statement) не выводит диапазон для
+    ix_tasks_tag_priority_created. Спецсимволы LIKE экранируем сами, шаблон — literal_execute.
+    """
+    escaped = prefix.replace("/", "//").replace("%", "/%").replace("_", "/_")
+    return bindparam("tag_prefix_pattern", escaped + "%", type_=String, literal_execute=True)
+
+
 async def lease_tasks(
     session: AsyncSession,
     *,
     kinds: Sequence[str] | None = None,
     limit: int = 10,
     lease_seconds: int = 60,
+    tag_prefix: str | None = None,
 ) -> list[Task]:
     """Атомарно переводит pending задачи в processing и возвращает их.
 
     Использует SELECT FOR UPDATE SKIP LOCKED чтобы поддерживать несколько воркеров.
+    tag_prefix ограничивает выборку задачами с tag LIKE '<prefix>%' (индекс по tag).
     """
     now = utcnow()
     lease_expires = now + timedelta(seconds=lease_seconds)
     q = select(Task).where(Task.status == "pending").order_by(Task.priority.asc(), Task.created_at.asc()).limit(limit).with_for_update(skip_locked=True)
     if kinds:
         q = q.where(Task.kind.in_(kinds))
+    if tag_prefix:
+        q = q.where(Task.tag.like(_tag_prefix_pattern(tag_prefix), escape="/"))
     rows = (await session.execute(q)).scalars().all()
     leased: list[Task] = []
     for task in rows:
@@ -105,3 +257,5 @@ async def return_to_pending(session: AsyncSession, task_ids: Iterable[int]) -> N
         .where(Task.id.in_(ids), Task.status == "processing")
         .values(status="pending", lease_expires_at=None, heartbeat_at=None)
     )
+    # задача снова pending — будим слушателей, чтобы повтор не ждал idle-опроса
+    await notify_new_tasks(session)
@@ -11,6 +11,7 @@ from datetime import datetime
 from sqlalchemy import select, update
 from sqlalchemy.ext.asyncio import AsyncSession
 from app.db.models import Task
+from app.db.task_queue import notify_new_tasks
 from app.utils.time import utcnow
 
 MAX_ATTEMPTS = 5
@@ -36,6 +37,8 @@ async def watchdog_pass(session: AsyncSession) -> dict[str, int]:
             .values(status="pending", lease_expires_at=None, heartbeat_at=None)
         )
         stats["returned"] = len(to_return)
+        # вернули в pending — будим воркеры по NOTIFY, а не ждём их idle-опроса
+        await notify_new_tasks(session)
     if to_fail:
         await session.execute(
             update(Task)
@@ -0,0 +1,30 @@
+from __future__ import annotations
+
+"""Asyncio helpers: structured fan-out over independent coroutines."""
+
+import asyncio
+from typing import Any, Coroutine, Iterable, TypeVar
+
+T = TypeVar("T")
+
+
+async def concurrent_map(
+    coros: Iterable[Coroutine[Any, Any, T]], *, return_exceptions: bool = False
+) -> list[T | BaseException]:
+    """Run coroutines concurrently in a TaskGroup, return results in input order.
+
+    By default the first failure cancels the remaining coroutines and an
+    ExceptionGroup is raised. With return_exceptions=True each coroutine's
+    Exception is returned in its slot instead (like asyncio.gather), while
+    cancelling the caller still cancels and awaits every child.
+    """
+
+    async def _capture(coro: Coroutine[Any, Any, T]) -> T | BaseException:
+        try:
+            return await coro
+        except Exception as e:
+            return e
+
+    async with asyncio.TaskGroup() as tg:
+        tasks = [tg.create_task(_capture(c) if return_exceptions else c) for c in coros]
+    return [t.result() for t in tasks]
@@ -23,25 +23,44 @@ from io import BytesIO
 from typing import Optional, Dict, List
 import time
 from collections import deque
+from dataclasses import dataclass, field
 
+from cachetools import LRUCache, TTLCache
 from dotenv import load_dotenv
-from sqlalchemy import delete
+from sqlalchemy import insert, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from pyrogram import Client, filters
 from pyrogram.enums import ChatAction, ChatType
-from pyrogram.types import Message
+from pyrogram.types import Message, User
 import httpx
 
 from app.config.settings import get_settings
 from app.db.base import session_scope
 from app.bot.services.reply_flow import process_user_text, buffer_or_process, flush_pending_input, flush_expired_pending_input
-from app.db.task_queue import enqueue_task, lease_tasks, complete, heartbeat, return_to_pending
+from app.db.task_queue import enqueue_task, enqueue_tasks, lease_tasks, new_task_listener, complete, heartbeat, return_to_pending
 from app.db.task_watchdog import watchdog_pass
 from app.bot.services.metrics import metrics
 from app.bot.services.logging import get_logger
-from app.db.models import ProactiveOutbox, AssistantMessage, ChatState, Message as DBMessage, Chat
+from app.db.models import ProactiveOutbox, AssistantMessage, ChatState, Chat
 from app.utils.time import utcnow
 
 
+# /reset одним запросом: удаление истории (обе таблицы) и upsert состояния с инкрементом memory_rev.
+# Новое состояние получает memory_rev=2, как и раньше при (None or 1) + 1.
+_RESET_CHAT_SQL = text(
+    """
+    WITH d_user AS (DELETE FROM messages WHERE chat_id = :c),
+         d_assistant AS (DELETE FROM assistant_messages WHERE chat_id = :c)
+    INSERT INTO chat_state (chat_id, memory_rev) VALUES (:c, 2)
+    ON CONFLICT (chat_id) DO UPDATE SET
+        memory_rev = chat_state.memory_rev + 1,
+        last_user_msg_at = NULL,
+        last_assistant_at = NULL,
+        next_proactive_at = NULL
+    """
+)
+
+
 class PyroBotShim:
     """Minimal shim to satisfy process_user_text(bot=...)."""
 
@@ -78,38 +97,121 @@ class PyroBotShim:
                 await self.client.send_chat_action(chat_id, ChatAction.TYPING)
 
 
+@dataclass
+class BufferState:
+    """Per-chat batch buffer: accumulated messages plus the state its flush timer sleeps on.
+
+    Keeps only ids, texts and authors of buffered messages; the full Message object is
+    retained for the latest one only (it is the reply base). Appends only move
+    ``last_at``; the timer is woken early solely through ``full``.
+    """
+
+    ids: List[int] = field(default_factory=list)
+    texts: List[str] = field(default_factory=list)
+    authors: List[Optional[User]] = field(default_factory=list)
+    base: Optional[Message] = None
+    last_at: float = 0.0
+    full: asyncio.Event = field(default_factory=asyncio.Event)
+    task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def append(self, message: Message, now: float) -> None:
+        self.ids.append(message.id)
+        self.texts.append(message.text or "")
+        self.authors.append(message.from_user)
+        self.base = message
+        self.last_at = now
+
+    def clear(self) -> None:
+        self.ids, self.texts, self.authors, self.base = [], [], [], None
+
+
+@dataclass
+class ChatRuntime:
+    """In-process state of one chat: reply quoting, batch buffer and in-flight work."""
+
+    recent_msg_ids: deque = field(default_factory=lambda: deque(maxlen=20))
+    cancel_events: deque = field(default_factory=deque)
+    last_cancel_at: float = 0.0
+    photo_inflight_at: Optional[float] = None
+    # Выставляется медиа-хендлером, когда загрузка закончена и pending-буфер (если есть) записан
+    photo_ready: asyncio.Event = field(default_factory=asyncio.Event)
+    inflight_task: Optional[asyncio.Task] = None
+    buffer: Optional[BufferState] = None
+    # FIFO-лок: входящие тексты одного чата обрабатываются строго по порядку
+    incoming_lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+
+class ChatRuntimeCache(LRUCache):
+    """Size-bounded chat_id -> ChatRuntime map; unknown chats get a fresh runtime on access."""
+
+    def __missing__(self, chat_id: int) -> ChatRuntime:
+        rt = ChatRuntime()
+        self[chat_id] = rt
+        return rt
+
+
 async def typing_loop(client: Client, chat_id: int, interval: float):
-    """Continuously send typing action until cancelled."""
+    """Refresh typing action every `interval` seconds until cancelled, then clear it at once."""
     try:
         while True:
-            await client.send_chat_action(chat_id, ChatAction.TYPING)
             await asyncio.sleep(interval)
+            await client.send_chat_action(chat_id, ChatAction.TYPING)
     except asyncio.CancelledError:
         return
+    finally:
+        # Гасим индикатор сразу, а не ждём пока Telegram сам его снимет через ~5с
+        with contextlib.suppress(Exception):
+            await client.send_chat_action(chat_id, ChatAction.CANCEL)
+
+
+async def start_typing(client: Client, chat_id: int, interval: float) -> asyncio.Task:
+    """Send the first typing action right away and return the task that keeps it alive."""
+    with contextlib.suppress(Exception):
+        await client.send_chat_action(chat_id, ChatAction.TYPING)
+    return asyncio.create_task(typing_loop(client, chat_id, interval))
+
+
+# Values are 'private', 'bot', 'group', 'supergroup', 'channel'; None -> private
+_CHAT_TYPE_STR: Dict[ChatType | None, str] = {t: t.value for t in ChatType}
+_CHAT_TYPE_STR[None] = "private"
 
 
 def _chat_type_str(chat_type: ChatType | str | None) -> str:
-    if chat_type is None:
-        return "private"
-    if isinstance(chat_type, ChatType):
-        # Values are 'private', 'group', 'supergroup', 'channel'
-        return chat_type.value
-    return str(chat_type)
+    return _CHAT_TYPE_STR.get(chat_type) or str(chat_type)
+
+
+_GROUP_CHAT_TYPES = frozenset((ChatType.GROUP, ChatType.SUPERGROUP))
 
 
 def _is_for_me(msg: Message, my_id: int) -> bool:
-    if msg.chat.type in (ChatType.PRIVATE,):
+    chat_type = msg.chat.type
+    if chat_type is ChatType.PRIVATE:
         return True
-    # For groups/supergroups: only react when mentioned or replied to me
-    if msg.chat.type in (ChatType.GROUP, ChatType.SUPERGROUP):
-        if getattr(msg, "mentioned", False):
+    # For groups/supergroups: only react when mentioned or replied to me.
+    # mentioned выставляет сам Telegram (в т.ч. для @username), разбирать текст не нужно
+    if chat_type in _GROUP_CHAT_TYPES:
+        if msg.mentioned:
             return True
-        if msg.reply_to_message and msg.reply_to_message.from_user and msg.reply_to_message.from_user.id == my_id:
+        reply = msg.reply_to_message
+        if reply and reply.from_user and reply.from_user.id == my_id:
             return True
     return False
 
 
 async def main() -> None:
+    # Один HTTP-клиент на все загрузки медиа: keep-alive вместо нового соединения на каждое сообщение.
+    # async with закрывает его при любом выходе, в том числе если упал старт клиента или воркеров
+    async with httpx.AsyncClient(
+        timeout=httpx.Timeout(60.0),
+        limits=httpx.Limits(max_keepalive_connections=32),
+    ) as upload_client:
+        await _run(upload_client)
+
+
+async def _run(upload_client: httpx.AsyncClient) -> None:
     load_dotenv()
     settings = get_settings()
 
@@ -137,43 +239,26 @@ async def main() -> None:
     if reply_quote_every_max < reply_quote_every_min:
         reply_quote_every_max = reply_quote_every_min
 
-    # Per-chat counters and thresholds
-    reply_counters: Dict[int, int] = {}
-    reply_thresholds: Dict[int, int] = {}
-    recent_user_msgs: Dict[int, deque[int]] = {}
-
-    def _new_threshold() -> int:
-        return random.randint(reply_quote_every_min, reply_quote_every_max)
+    # Всё рантайм-состояние чатов в одном LRU: давно молчащие чаты вытесняются, память ограничена
+    chats = ChatRuntimeCache(maxsize=int(os.getenv("USERBOT_CHAT_RUNTIME_MAX", "10000")))
+    # Чаты, где фото-буфера в БД точно нет: текст идёт сразу в обработку без SELECT ... FOR UPDATE.
+    # Кэшируем только отсутствие — фото-хендлер и /reset инвалидируют запись, TTL страхует от внешних писателей
+    no_pending_photo: TTLCache = TTLCache(
+        maxsize=int(os.getenv("USERBOT_PENDING_CACHE_MAX", "5000")),
+        ttl=float(os.getenv("USERBOT_PENDING_CACHE_TTL", "60")),
+    )
 
-    # Стратегия выбора сообщения для ответа зафиксирована: всегда последнее входящее
-    reply_quote_strategy = "last"
+    # Цитируем в среднем раз в (min+max)/2 ответов: вероятность на каждый ответ вместо счётчиков по чатам
+    reply_quote_p = 2.0 / (reply_quote_every_min + reply_quote_every_max) if reply_quote_every_max > 0 else 0.0
 
     def _select_reply_to(chat_id: int) -> Optional[int]:
         if not reply_quote_enabled:
             return None
-        cnt = reply_counters.get(chat_id, 0) + 1
-        reply_counters[chat_id] = cnt
-        thr = reply_thresholds.get(chat_id)
-        if thr is None or thr <= 0:
-            thr = _new_threshold()
-            reply_thresholds[chat_id] = thr
-        if cnt >= thr:
-            reply_counters[chat_id] = 0
-            reply_thresholds[chat_id] = _new_threshold()
-            dq = recent_user_msgs.get(chat_id)
-            if dq and len(dq) > 0:
-                try:
-                    if reply_quote_strategy == "last":
-                        return dq[-1]
-                    elif reply_quote_strategy == "first":
-                        return dq[0]
-                    else:  # random
-                        idx = random.randrange(0, len(dq))
-                        return list(dq)[idx]
-                except Exception:
-                    with contextlib.suppress(Exception):
-                        return dq[-1]
-        return None
+        # Отвечаем всегда на последнее входящее сообщение
+        dq = chats[chat_id].recent_msg_ids
+        if not dq:
+            return None
+        return dq[-1] if random.random() < reply_quote_p else None
 
     shim = PyroBotShim(app, reply_selector=_select_reply_to, suppress_errors=True)
 
@@ -184,7 +269,7 @@ async def main() -> None:
     mark_read_mode = os.getenv("USERBOT_MARK_READ_MODE", "after_reply").lower()
     delay_mark_read_sec = float(os.getenv("USERBOT_DELAY_MARK_READ", "0"))  # для mode=delay
     random_read_min = float(os.getenv("USERBOT_MARK_READ_RANDOM_MIN", "1.0"))
-    random_read_max = float(os.getenv("USERBOT_MARK_READ_RANDOM_MAX", "5.0"))
+    random_read_max = max(random_read_min, float(os.getenv("USERBOT_MARK_READ_RANDOM_MAX", "5.0")))
     # Новая опция: принудительно читать до начала typing-индикации
     read_before_typing = os.getenv("USERBOT_READ_BEFORE_TYPING", "1").lower() in {"1","true","yes","on"}
 
@@ -196,10 +281,15 @@ async def main() -> None:
     pre_proc_min = float(os.getenv("USERBOT_PRE_PROCESS_DELAY_MIN", "0"))
     pre_proc_max = float(os.getenv("USERBOT_PRE_PROCESS_DELAY_MAX", "0"))
     typing_enabled = os.getenv("USERBOT_TYPING", "1").lower() in {"1", "true", "yes", "on"}
-    typing_interval = float(os.getenv("USERBOT_TYPING_INTERVAL", "4"))
+    # Индикатор Telegram живёт ~5–6с, чаще обновлять незачем
+    typing_interval = float(os.getenv("USERBOT_TYPING_INTERVAL", "5"))
     min_typing_seconds = float(os.getenv("USERBOT_MIN_TYPING_SECONDS", "0"))  # ensure at least this visual typing
+    # Задержки с нулевым диапазоном отключаем на старте, чтобы не дёргать random/sleep на каждое сообщение
+    pre_proc_enabled = pre_proc_max > 0 and pre_proc_min <= pre_proc_max
+    typing_delay_enabled = typing_enabled and typing_start_delay_max > 0 and typing_start_delay_min <= typing_start_delay_max
 
-    my_id_box: dict[str, int] = {}
+    # Собственный user id: заполняется из app.me сразу после app.start(), до первого апдейта
+    my_id: int = 0
 
     # Batch configuration
     batch_enabled = os.getenv("USERBOT_BATCH_ENABLED", "0").lower() in {"1","true","yes","on"}
@@ -213,129 +303,132 @@ async def main() -> None:
     cancel_on_new_msg = os.getenv("USERBOT_CANCEL_ON_NEW_MSG", "1").lower() in {"1","true","yes","on"}
     # Wait time to attach follow-up text to a photo that's still uploading
     photo_agg_wait = float(os.getenv("USERBOT_PHOTO_AGGREGATION_WAIT", "3.0"))
-
-    # Буфер по chat_id
-    message_buffers: Dict[int, List[Message]] = {}
-    buffer_tasks: Dict[int, asyncio.Task] = {}
-    inflight_tasks: Dict[int, asyncio.Task] = {}
-    last_message_ts: Dict[int, float] = {}
-    cancel_events: Dict[int, List[float]] = {}
-    debounce_timers: Dict[int, float] = {}
-    # Chats where a photo is being processed (uploading/creating DB pending)
-    photo_inflight: Dict[int, float] = {}
-
-    def _start_generation(chat_id: int, base: Message, combined_text: str):
+    # Ограничение одновременных генераций (вызовов n8n + отправок) и учёт фоновых задач для остановки
+    gen_sem = asyncio.Semaphore(int(os.getenv("USERBOT_MAX_CONCURRENT_GEN", "8")))
+    gen_tasks: set[asyncio.Task] = set()
+    # Таймеры пакетов тоже гасим при остановке, иначе их отменит asyncio.run уже после app.stop()
+    buffer_timers: set[asyncio.Task] = set()
+    # Фоновые воркеры: держим ссылки (иначе задачу может собрать GC), логируем падения, гасим при остановке
+    workers: list[asyncio.Task] = []
+
+    def _on_worker_done(task: asyncio.Task) -> None:
+        if not task.cancelled() and (exc := task.exception()) is not None:
+            get_logger().error("worker_died", name=task.get_name(), error=str(exc))
+
+    def _spawn_worker(coro, name: str) -> None:
+        task = asyncio.create_task(coro, name=name)
+        task.add_done_callback(_on_worker_done)
+        workers.append(task)
+    # Загрузки медиа идут через общий upload_client из main()
+    upload_url = str(settings.public_base_url).rstrip("/") + "/upload"
+    max_upload_bytes = settings.max_upload_bytes
+
+    def _start_generation(chat_id: int, base: Message, combined_text: str, count: int):
         get_logger().info(
             "buffer_generation_start",
             chat_id=chat_id,
-            messages=len(message_buffers.get(chat_id, [])),
+            messages=count,
             sample=combined_text[:120],
         )
         task = asyncio.create_task(_process_single(app, shim, base, combined_text))
-        inflight_tasks[chat_id] = task
+        gen_tasks.add(task)
+        rt = chats[chat_id]
+        rt.inflight_task = task
         def _cleanup(_):
-            # убрать из карты по завершению (успех/ошибка/отмена)
-            if inflight_tasks.get(chat_id) is task:
-                inflight_tasks.pop(chat_id, None)
+            # убрать из состояния чата по завершению (успех/ошибка/отмена)
+            gen_tasks.discard(task)
+            if rt.inflight_task is task:
+                rt.inflight_task = None
         task.add_done_callback(_cleanup)
         return task
 
-    async def flush_buffer(chat_id: int):
-        msgs = message_buffers.get(chat_id, [])
-        if not msgs:
+    async def flush_buffer(chat_id: int, state: BufferState, reason: str):
+        log = get_logger().bind(chat_id=chat_id)
+        # Отцепляем буфер сразу: новые сообщения начнут следующий пакет со своим таймером
+        rt = chats.get(chat_id)
+        if rt is not None and rt.buffer is state:
+            rt.buffer = None
+        ids, texts, authors, base = state.ids, state.texts, state.authors, state.base
+        state.clear()
+        if not ids or base is None:
             return
-        base = msgs[-1]
-        combined_text = " \n".join(m.text or "" for m in msgs)
-        message_buffers[chat_id] = []
-        get_logger().info(
+        # Пустые части не склеиваем: иначе в тексте появляются висячие разделители
+        combined_text = " \n".join([t for t in texts if t])
+        log.info(
             "buffer_flush",
-            chat_id=chat_id,
-            count=len(msgs),
-            reason=current_flush_reasons.get(chat_id, "unknown"),
+            count=len(ids),
+            reason=reason,
             total_chars=len(combined_text),
         )
+        # Лимит сообщений при включённой очереди: пакет уходит задачей (dedup, ретраи, tasks_worker)
+        if use_queue and reason == "max_messages":
+            await _enqueue_incoming(base, combined_text, media=None, source="batch")
+            return
         # Persist originals as separate Message rows BEFORE aggregated processing to keep fine-grained history
         try:
             from app.db.models import Message as DBMessage, ChatState as DBChatState, Chat as DBChat, User as DBUser
             async with session_scope() as session:
-                for m in msgs:
+                for tg_id, text_val, author in zip(ids, texts, authors):
                     try:
                         # Minimal ensure of user/chat presence (fast path)
-                        if await session.get(DBChat, m.chat.id) is None:
-                            session.add(DBChat(id=m.chat.id, type=_chat_type_str(m.chat.type)))
-                        if m.from_user and await session.get(DBUser, m.from_user.id) is None:
-                            session.add(DBUser(id=m.from_user.id, username=m.from_user.username, lang=getattr(m.from_user, 'language_code', None)))
-                        session.add(DBMessage(chat_id=m.chat.id, user_id=(m.from_user.id if m.from_user else None), text=m.text or "", tg_message_id=m.id))
+                        if await session.get(DBChat, chat_id) is None:
+                            session.add(DBChat(id=chat_id, type=_chat_type_str(base.chat.type)))
+                        if author and await session.get(DBUser, author.id) is None:
+                            session.add(DBUser(id=author.id, username=author.username, lang=author.language_code))
+                        session.add(DBMessage(chat_id=chat_id, user_id=(author.id if author else None), text=text_val, tg_message_id=tg_id))
                     except Exception as e:
-                        get_logger().warning("user_batch_persist_error", chat_id=m.chat.id, tg_message_id=m.id, error=str(e))
-                get_logger().info("user_batch_persist", chat_id=chat_id, persisted=len(msgs))
+                        log.warning("user_batch_persist_error", tg_message_id=tg_id, error=str(e))
+                log.info("user_batch_persist", persisted=len(ids))
         except Exception as e:
-            get_logger().error("user_batch_persist_fatal", chat_id=chat_id, error=str(e))
-        _start_generation(chat_id, base, combined_text)
-
-    current_flush_reasons: Dict[int, str] = {}
+            log.error("user_batch_persist_fatal", error=str(e))
+        _start_generation(chat_id, base, combined_text, len(ids))
 
-    async def schedule_buffer_send(chat_id: int):
-        get_logger().info("buffer_timer_start", chat_id=chat_id, inactivity=batch_inactivity_sec, max_messages=batch_max_messages)
+    async def schedule_buffer_send(chat_id: int, state: BufferState):
+        log = get_logger().bind(chat_id=chat_id)
+        log.info("buffer_timer_start", inactivity=batch_inactivity_sec, max_messages=batch_max_messages)
+        reason = "unknown"
         try:
+            # Спим до конца окна тишины от последнего сообщения: новые сообщения лишь сдвигают last_at,
+            # таймер просыпается один раз на окно (или раньше, если буфер заполнен), а не на каждое сообщение
             while True:
-                await asyncio.sleep(0.3)
-                if chat_id not in message_buffers:
-                    get_logger().info("buffer_timer_break", chat_id=chat_id, reason="no_buffer_entry")
-                    break
-                buf = message_buffers.get(chat_id, [])
-                size = len(buf)
-                if not buf:
-                    continue
-                last_ts = last_message_ts.get(chat_id, 0)
-                idle = time.monotonic() - last_ts
-                # Периодический тик
-                if int(time.monotonic()*10) % 20 == 0:  # примерно каждые ~2с
-                    get_logger().debug(
-                        "buffer_timer_tick",
-                        chat_id=chat_id,
-                        size=size,
-                        idle_round=round(idle,2),
-                        threshold=batch_inactivity_sec,
-                    )
-                if idle >= batch_inactivity_sec:
-                    current_flush_reasons[chat_id] = "inactivity"
-                    get_logger().info("buffer_timer_break", chat_id=chat_id, reason="inactivity", size=size, idle=round(idle,2))
+                if len(state) >= batch_max_messages:
+                    reason = "max_messages"
                     break
-                if size >= batch_max_messages:
-                    current_flush_reasons[chat_id] = "max_messages"
-                    get_logger().info("buffer_timer_break", chat_id=chat_id, reason="max_messages", size=size)
+                remaining = batch_inactivity_sec - (time.monotonic() - state.last_at)
+                if remaining <= 0:
+                    reason = "inactivity"
                     break
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(state.full.wait(), timeout=remaining)
+            log.info("buffer_timer_break", reason=reason, size=len(state))
+        except asyncio.CancelledError:
+            # Остановка или /reset: новую работу (запись в БД, генерацию) не начинаем
+            log.info("buffer_timer_cancelled", size=len(state))
+            raise
         except Exception as e:
-            get_logger().error("buffer_timer_error", chat_id=chat_id, error=str(e))
-        finally:
-            try:
-                await flush_buffer(chat_id)
-            except Exception as e:
-                get_logger().error("buffer_flush_error", chat_id=chat_id, error=str(e))
-            buffer_tasks.pop(chat_id, None)
+            log.error("buffer_timer_error", error=str(e))
+        try:
+            await flush_buffer(chat_id, state, reason)
+        except Exception as e:
+            log.error("buffer_flush_error", error=str(e))
 
     async def _process_single(app: Client, shim: PyroBotShim, message: Message, text: str, media: Optional[Dict] = None, *, disable_local_typing: bool = False, use_buffer: bool = False):
         trace_id = str(uuid.uuid4())
         try:
-            return await _process_single_inner(app, shim, message, text, media, disable_local_typing=disable_local_typing, use_buffer=use_buffer, trace_id=trace_id)
+            # Не больше gen_sem генераций одновременно: остальные ждут слота, а не давят на n8n/Telegram
+            async with gen_sem:
+                return await _process_single_inner(app, shim, message, text, media, disable_local_typing=disable_local_typing, use_buffer=use_buffer, trace_id=trace_id)
         except asyncio.CancelledError:
+            # Только логируем: отмена должна дойти до вызывающего (gather в /reset, остановка)
             get_logger().info("userbot_task_cancelled", chat_id=message.chat.id, trace_id=trace_id)
-            return
+            raise
         except Exception as e:
             get_logger().error("userbot_task_failed", chat_id=message.chat.id, error=str(e), trace_id=trace_id)
             # fallback можно добавить по желанию
             return
 
     async def _process_single_inner(app: Client, shim: PyroBotShim, message: Message, text: str, media: Optional[Dict] = None, *, disable_local_typing: bool = False, use_buffer: bool = False, trace_id: Optional[str] = None):
-        # Lazy initialize my own user id
-        if not my_id_box:
-            me = await app.get_me()
-            my_id_box["id"] = me.id
-        if not _is_for_me(message, my_id_box["id"]):
-            return
-        if message.from_user and getattr(message.from_user, "is_bot", False):
-            return
+        # Адресность и отправитель уже проверены фильтром хендлера (см. incoming)
         chat = message.chat
         user = message.from_user
         # Автоматически помечаем чат для проактивов через userbot
@@ -344,9 +437,8 @@ async def main() -> None:
         except Exception:
             pass
         # Опциональная случайная задержка ДО любой активности (имитация того, что "прочитал не мгновенно")
-        if pre_proc_max > 0 and pre_proc_max >= pre_proc_min and (pre_proc_min > 0 or pre_proc_max > 0):
-            pre_sleep = random.uniform(pre_proc_min, pre_proc_max)
-            await asyncio.sleep(pre_sleep)
+        if pre_proc_enabled:
+            await asyncio.sleep(random.uniform(pre_proc_min, pre_proc_max))
 
         read_done = False
         read_task: Optional[asyncio.Task] = None
@@ -362,7 +454,7 @@ async def main() -> None:
                     read_done = True
             elif mark_read_mode == "random":
                 # Планируем случайное прочтение (если пользователь успеет получить ответ раньше — может прочитаться позже)
-                rand_delay = random.uniform(random_read_min, max(random_read_min, random_read_max))
+                rand_delay = random.uniform(random_read_min, random_read_max)
 
                 async def _delayed_read():
                     nonlocal read_done
@@ -377,69 +469,64 @@ async def main() -> None:
 
                 read_task = asyncio.create_task(_delayed_read())
         # Возможная задержка ПОСЛЕ чтения и ПЕРЕД началом typing
-        if typing_enabled and typing_start_delay_max >= typing_start_delay_min and typing_start_delay_max > 0:
+        if typing_delay_enabled:
             await asyncio.sleep(random.uniform(typing_start_delay_min, typing_start_delay_max))
 
         start_t = time.monotonic()
         typing_task: Optional[asyncio.Task] = None
         if typing_enabled and not disable_local_typing:
-            typing_task = asyncio.create_task(typing_loop(app, chat.id, typing_interval))
+            typing_task = await start_typing(app, chat.id, typing_interval)
+        # Отмена (новое сообщение, /reset, остановка) пробрасывается: session_scope не коммитит, сессия
+        # закрывается с откатом, а typing/чтение гасятся в finally ниже
         try:
-            cancelled = False
             async with session_scope() as session:
-                try:
-                    if use_buffer:
-                        # Перед добавлением текста пробуем авто-флаш просроченного буфера
-                        await flush_pending_input(shim, session, chat_id=chat.id, settings=settings)
-                        marker = await buffer_or_process(
-                            shim,
-                            session,
-                            chat_id=chat.id,
-                            chat_type=_chat_type_str(chat.type),
-                            user_id=(user.id if user else None),
-                            username=(user.username if user else None),
-                            lang=(getattr(user, "language_code", None) if user else None),
-                            text=text,
-                            media=media,
-                            settings=settings,
-                            trace_id=trace_id,
-                        )
-                        # Если просто буфер — ответа сейчас не будет
-                        if marker in {"(buffer_started)", "(buffer_extended)"}:
-                            return
-                    else:
-                        await process_user_text(
-                            shim,
-                            session,
-                            chat_id=chat.id,
-                            chat_type=_chat_type_str(chat.type),
-                            user_id=(user.id if user else None),
-                            username=(user.username if user else None),
-                            lang=(getattr(user, "language_code", None) if user else None),
-                            text=text,
-                            media=media,
-                            settings=settings,
-                            trace_id=trace_id,
-                        )
-                except asyncio.CancelledError:
-                    cancelled = True
-                    with contextlib.suppress(Exception):
-                        await session.rollback()
-                # exit context manager normally to ensure proper cleanup
+                if use_buffer:
+                    # Перед добавлением текста пробуем авто-флаш просроченного буфера
+                    await flush_pending_input(shim, session, chat_id=chat.id, settings=settings)
+                    marker = await buffer_or_process(
+                        shim,
+                        session,
+                        chat_id=chat.id,
+                        chat_type=_chat_type_str(chat.type),
+                        user_id=(user.id if user else None),
+                        username=(user.username if user else None),
+                        lang=(user.language_code if user else None),
+                        text=text,
+                        media=media,
+                        settings=settings,
+                        trace_id=trace_id,
+                    )
+                    # Если просто буфер — ответа сейчас не будет
+                    if marker in {"(buffer_started)", "(buffer_extended)"}:
+                        return
+                else:
+                    await process_user_text(
+                        shim,
+                        session,
+                        chat_id=chat.id,
+                        chat_type=_chat_type_str(chat.type),
+                        user_id=(user.id if user else None),
+                        username=(user.username if user else None),
+                        lang=(user.language_code if user else None),
+                        text=text,
+                        media=media,
+                        settings=settings,
+                        trace_id=trace_id,
+                    )
             # Как только реальный ответ отправлен (функция вернулась) — убираем индикацию набора,
             # чтобы не возникал повторный "всплеск" typing через пару секунд.
             if typing_task:
                 typing_task.cancel()
                 with contextlib.suppress(Exception):
                     await typing_task
-            if not cancelled and typing_enabled and min_typing_seconds > 0:
+            if typing_enabled and min_typing_seconds > 0:
                 # Додерживаем минимальное время ТОЛЬКО если ответ пришёл слишком быстро,
                 # но уже без новых send_chat_action (индикатор просто погаснет чуть раньше — это ок).
                 elapsed = time.monotonic() - start_t
                 remaining = min_typing_seconds - elapsed
                 if remaining > 0:
                     await asyncio.sleep(remaining)
-            if not cancelled and mark_read_mode in {"after_reply", "delay"}:
+            if mark_read_mode in {"after_reply", "delay"}:
                 if mark_read_mode == "delay" and delay_mark_read_sec > 0:
                     await asyncio.sleep(delay_mark_read_sec)
                 if not read_done:
@@ -448,7 +535,7 @@ async def main() -> None:
                         read_done = True
         finally:
             # Финальное страхующее отключение (если отменили раньше — ничего не произойдёт)
-            if typing_task and not typing_task.cancelled():
+            if typing_task and not typing_task.done():
                 typing_task.cancel()
                 with contextlib.suppress(Exception):
                     await typing_task
@@ -458,51 +545,45 @@ async def main() -> None:
                     read_task.cancel()
                     with contextlib.suppress(Exception):
                         await read_task
-        # Если задача была отменена — корректно выходим без ответа
-        if locals().get("cancelled"):
-            return
 
-    @app.on_message(filters.command(["reset"]) & ~filters.me)
+    async def _for_me_filter(_, __, m: Message) -> bool:
+        # async: синхронные кастомные фильтры Pyrogram гоняет через thread executor
+        return _is_for_me(m, my_id)
+
+    # Не от нас, не от ботов и адресовано нам (для групп — упоминание/ответ) — проверяется диспетчером
+    # до вызова хендлера; my_id читается в момент проверки, после app.start()
+    incoming = ~filters.me & ~filters.bot & filters.create(_for_me_filter)
+
+    # Ограничим обработку командами, адресованными нам (для групп — при упоминании/ответе)
+    @app.on_message(filters.command(["reset"]) & incoming)
     async def handle_reset(_: Client, message: Message):
-        # Ограничим обработку командами, адресованными нам (для групп — при упоминании/ответе)
-        if not my_id_box:
-            me = await app.get_me()
-            my_id_box["id"] = me.id
-        if not _is_for_me(message, my_id_box["id"]):
-            return
         chat_id = message.chat.id
         # Остановим буферы/генерацию для чата
-        if task := buffer_tasks.get(chat_id):
-            task.cancel()
-            with contextlib.suppress(Exception):
-                await task
-            buffer_tasks.pop(chat_id, None)
-        if task := inflight_tasks.get(chat_id):
+        rt = chats[chat_id]
+        no_pending_photo.pop(chat_id, None)
+        to_cancel: list[asyncio.Task] = []
+        if (state := rt.buffer) is not None:
+            rt.buffer = None
+            # Очищаем сами: отменённый таймер буфер не сбрасывает и генерацию не запускает
+            state.clear()
+            if state.task:
+                to_cancel.append(state.task)
+        if rt.inflight_task:
+            to_cancel.append(rt.inflight_task)
+            rt.inflight_task = None
+        # Отменяем таймер и генерацию параллельно: ждём дольшую из них, а не сумму
+        for task in to_cancel:
             task.cancel()
-            with contextlib.suppress(Exception):
-                await task
-            inflight_tasks.pop(chat_id, None)
-        message_buffers[chat_id] = []
+        await asyncio.gather(*to_cancel, return_exceptions=True)
 
-        # Очистим историю чата и сбросим память
+        # Очистим историю чата и сбросим память: upsert чата + один CTE-запрос вместо серии get/delete
         async with session_scope() as session:
-            await session.execute(delete(DBMessage).where(DBMessage.chat_id == chat_id))
-            await session.execute(delete(AssistantMessage).where(AssistantMessage.chat_id == chat_id))
-            
-            # Убедимся, что запись чата существует
-            chat = await session.get(Chat, chat_id)
-            if chat is None:
-                chat = Chat(id=chat_id)
-                session.add(chat)
-            
-            state = await session.get(ChatState, chat_id)
-            if state is None:
-                state = ChatState(chat_id=chat_id)
-                session.add(state)
-            state.last_user_msg_at = None
-            state.last_assistant_at = None
-            state.next_proactive_at = None
-            state.memory_rev = (state.memory_rev or 1) + 1
+            await session.execute(
+                pg_insert(Chat)
+                .values(id=chat_id, type=_chat_type_str(message.chat.type))
+                .on_conflict_do_nothing(index_elements=[Chat.id])
+            )
+            await session.execute(_RESET_CHAT_SQL, {"c": chat_id})
 
         await app.send_message(chat_id, "Контекст очищен: история сброшена, память перезапущена. Можешь продолжать.")
 
@@ -517,270 +598,255 @@ async def main() -> None:
                 res = await session.execute(_sql_text("SELECT version_num FROM alembic_version"))
                 row = res.first()
                 current = row[0] if row else None
-                expected_head = "0013_add_tg_message_id"
+                expected_head = "0016_add_task_tag"
                 get_logger().info("migrations_status", current=current, expected=expected_head, up_to_date=(current == expected_head))
         except Exception as e:
             get_logger().warning("migrations_status_error", error=str(e))
-    asyncio.create_task(_check_migrations())
+    _spawn_worker(_check_migrations(), "check_migrations")
+
+    async def _add_incoming_task(session, message: Message, combined_text: str, media: Optional[Dict] = None, source: str = "live"):
+        cid = message.chat.id
+        user = message.from_user
+        payload = {
+            "telegram_message_id": message.id,
+            "chat_id": cid,
+            "chat_type": _chat_type_str(message.chat.type),
+            "user_id": user.id if user else None,
+            "username": user.username if user else None,
+            "lang": user.language_code if user else None,
+            "text": combined_text,
+            "media": media,
+            "trace_id": str(uuid.uuid4()),
+            "source": source,
+        }
+        # dedup по (chat_id, telegram_message_id) для одиночных сообщений
+        dedup = f"inmsg:{cid}:{message.id}"
+        await enqueue_task(session, kind="incoming_user_message", payload=payload, priority=100, dedup_key=dedup, tag=f"chat:{cid}")
+        metrics.inc("tasks_created_total", labels={"kind": "incoming_user_message", "source": source})
+        get_logger().info("task_enqueue", kind="incoming_user_message", chat_id=cid, tg_message_id=message.id, source=source, trace_id=payload["trace_id"])
 
     async def _enqueue_incoming(message: Message, combined_text: str, media: Optional[Dict] = None, source: str = "live"):
         async with session_scope() as session:
-            payload = {
-                "telegram_message_id": message.id,
-                "chat_id": message.chat.id,
-                "chat_type": _chat_type_str(message.chat.type),
-                "user_id": getattr(message.from_user, 'id', None) if message.from_user else None,
-                "username": getattr(message.from_user, 'username', None) if message.from_user else None,
-                "lang": getattr(message.from_user, 'language_code', None) if message.from_user else None,
-                "text": combined_text,
-                "media": media,
-                "trace_id": str(uuid.uuid4()),
-                "source": source,
-            }
-            # dedup по (chat_id, telegram_message_id) для одиночных сообщений
-            dedup = f"inmsg:{message.chat.id}:{message.id}"
-            await enqueue_task(session, kind="incoming_user_message", payload=payload, priority=100, dedup_key=dedup)
-            metrics.inc("tasks_created_total", labels={"kind": "incoming_user_message", "source": source})
-            get_logger().info("task_enqueue", kind="incoming_user_message", chat_id=message.chat.id, tg_message_id=message.id, source=source, trace_id=payload["trace_id"])
+            await _add_incoming_task(session, message, combined_text, media, source=source)
 
-    @app.on_message(filters.text & ~filters.me)
-    async def handle_text(_: Client, message: Message):
-        # Lazy initialize my own user id
-        if not my_id_box:
-            me = await app.get_me()
-            my_id_box["id"] = me.id
-        if not _is_for_me(message, my_id_box["id"]):
-            return
-        if message.from_user and getattr(message.from_user, "is_bot", False):
-            return
+    # Тяжёлая часть handle_text (БД, ожидание фото) идёт в отдельной задаче, чтобы не держать диспетчер апдейтов.
+    # Семафор ограничивает число одновременных обработок, чтобы не исчерпать пул соединений БД.
+    incoming_sem = asyncio.Semaphore(int(os.getenv("USERBOT_INCOMING_CONCURRENCY", "64")))
+    incoming_tasks: set[asyncio.Task] = set()
 
+    async def _process_incoming_text(message: Message, rt: ChatRuntime):
+        cid = message.chat.id
+        try:
+            async with rt.incoming_lock:
+                # Перегрузка: очередь задач уже является буфером — кладём сообщение сразу туда.
+                # Под локом чата, чтобы не обогнать его более ранние сообщения, и только когда обычный путь
+                # сделал бы то же самое: без пакетов, без фото в полёте и без pending-фото в БД
+                if (
+                    use_queue
+                    and not batch_enabled
+                    and incoming_sem.locked()
+                    and rt.photo_inflight_at is None
+                    and cid in no_pending_photo
+                ):
+                    get_logger().warning("incoming_overflow_enqueue", chat_id=cid, tg_message_id=message.id)
+                    await _enqueue_incoming(message, message.text or "", media=None, source="overflow")
+                    return
+                async with incoming_sem:
+                    await _handle_text_body(message, rt)
+        except Exception as e:
+            get_logger().error("incoming_text_failed", chat_id=cid, tg_message_id=message.id, error=str(e))
+
+    @app.on_message(filters.text & incoming)
+    async def handle_text(_: Client, message: Message):
+        rt = chats[message.chat.id]
         # Запоминаем id входящих юзерских сообщений для потенциального reply_to
-        dq = recent_user_msgs.setdefault(message.chat.id, deque(maxlen=20))
-        dq.append(message.id)
-        # Helper to append text to a pending photo buffer in DB and avoid double replies
-        async def _try_append_to_pending_photo() -> bool:
-            try:
-                async with session_scope() as session:
-                    state = await session.get(ChatState, message.chat.id)
-                    pending = getattr(state, 'pending_input_json', None) if state else None
-                    pending_is_photo = bool(pending and pending.get('media') and pending['media'].get('origin') == 'photo')
-                    if pending_is_photo:
-                        flushed = await flush_expired_pending_input(shim, session, chat_id=message.chat.id, settings=get_settings())
-                        if not flushed:
-                            await buffer_or_process(
-                                shim,
-                                session,
-                                chat_id=message.chat.id,
-                                chat_type=_chat_type_str(message.chat.type),
-                                user_id=(message.from_user.id if message.from_user else None),
-                                username=(message.from_user.username if message.from_user else None),
-                                lang=(getattr(message.from_user, 'language_code', None) if message.from_user else None),
-                                text=message.text or "",
-                                media=None,
-                                settings=get_settings(),
-                                trace_id=None,
-                            )
-                        return True
-            except Exception:
+        rt.recent_msg_ids.append(message.id)
+        task = asyncio.create_task(_process_incoming_text(message, rt))
+        incoming_tasks.add(task)
+        task.add_done_callback(incoming_tasks.discard)
+
+    async def _handle_text_body(message: Message, rt: ChatRuntime):
+        cid = message.chat.id
+        log = get_logger().bind(chat_id=cid)
+        # Helper to append text to a pending photo buffer in DB and avoid double replies.
+        # True — текст поглощён буфером; False — буфера нет или он только что сброшен по дедлайну.
+        async def _try_append_to_pending_photo(session) -> bool:
+            # ChatState читаем один раз и передаём дальше. Chat не подгружаем: он нужен только ensure_entities
+            # при flush, а там его достанет session.get — лишний SELECT по chats на горячем пути не нужен
+            state = await session.get(ChatState, cid, with_for_update=True)
+            pending = state.pending_input_json if state else None
+            pending_is_photo = bool(pending and pending.get('media') and pending['media'].get('origin') == 'photo')
+            if not pending_is_photo:
+                no_pending_photo[cid] = True
                 return False
-            return False
-
-        # Fast path: DB already has a pending photo buffer
-        if await _try_append_to_pending_photo():
-            return
-
-        # Slow path: a photo is in-flight (upload not finished) — wait briefly
-        ts = photo_inflight.get(message.chat.id)
-        if ts is not None and (time.monotonic() - ts) <= max(0.1, photo_agg_wait):
-            deadline = time.monotonic() + photo_agg_wait
-            while time.monotonic() < deadline:
-                if await _try_append_to_pending_photo():
-                    return
-                await asyncio.sleep(0.2)
+            # Если дедлайны истекли – flush, тогда текст станет новым буфером / сообщением.
+            if await flush_expired_pending_input(shim, session, chat_id=cid, settings=settings, state=state):
+                no_pending_photo[cid] = True
+                return False
+            # Буфер активен и не истёк – просто расширяем.
+            await buffer_or_process(
+                shim,
+                session,
+                chat_id=cid,
+                chat_type=_chat_type_str(message.chat.type),
+                user_id=(message.from_user.id if message.from_user else None),
+                username=(message.from_user.username if message.from_user else None),
+                lang=(message.from_user.language_code if message.from_user else None),
+                text=message.text or "",
+                media=None,
+                settings=settings,
+                trace_id=None,
+                state=state,
+            )
+            return True
 
+        # Slow path: a photo is in-flight (upload not finished) — ждём сигнала медиа-хендлера,
+        # после чего проверяем буфер один раз в общей транзакции ниже.
+        # Одно чтение часов на сообщение; обновляем только если реально ждали фото
+        now = time.monotonic()
+        ts = rt.photo_inflight_at
+        if ts is not None and (now - ts) <= max(0.1, photo_agg_wait):
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(rt.photo_ready.wait(), timeout=photo_agg_wait)
+            now = time.monotonic()
+
+        # Один SELECT ... FOR UPDATE по ChatState: проверка фото-буфера и постановка задачи в одной транзакции
+        async with session_scope() as session:
+            if cid not in no_pending_photo:
+                # Ошибка проверки (БД, n8n при flush) не должна терять текст: откатываем savepoint,
+                # считаем что фото-буфера нет и обрабатываем сообщение обычным путём
+                try:
+                    async with session.begin_nested():
+                        if await _try_append_to_pending_photo(session):
+                            return
+                except Exception as e:
+                    log.warning("pending_photo_check_failed", tg_message_id=message.id, error=str(e))
+            # Фото-буфера нет или он сброшен – обычная обработка (с проверкой на старт нового буфера в _process_single при use_buffer)
+            if not batch_enabled and use_queue:
+                await _add_incoming_task(session, message, message.text or "", media=None)
+                return
         if not batch_enabled:
-            # Попробуем сначала только истекший буфер сбросить. Если буфер активен (фото) и не истёк — просто расширяем его.
-            async with session_scope() as session:
-                state = await session.get(ChatState, message.chat.id)
-                pending = getattr(state, 'pending_input_json', None) if state else None
-                pending_is_photo = bool(pending and pending.get('media') and pending['media'].get('origin') == 'photo')
-                if pending_is_photo:
-                    # Если дедлайны истекли – flush, тогда текст станет новым буфером / сообщением.
-                    flushed = await flush_expired_pending_input(shim, session, chat_id=message.chat.id, settings=get_settings())
-                    if not flushed:
-                        # Буфер активен и не истёк – просто расширяем.
-                        await buffer_or_process(
-                            shim,
-                            session,
-                            chat_id=message.chat.id,
-                            chat_type=_chat_type_str(message.chat.type),
-                            user_id=(message.from_user.id if message.from_user else None),
-                            username=(message.from_user.username if message.from_user else None),
-                            lang=(getattr(message.from_user, 'language_code', None) if message.from_user else None),
-                            text=message.text or "",
-                            media=None,
-                            settings=get_settings(),
-                            trace_id=None,
-                        )
-                        return
-            # Если не было активного фото-буфера или он сброшен – обычная обработка (с проверкой на старт нового буфера в _process_single при use_buffer)
-            if use_queue:
-                await _enqueue_incoming(message, message.text or "", media=None)
-            else:
-                await _process_single(app, shim, message, message.text or "")
+            await _process_single(app, shim, message, message.text or "")
             return
 
         # Если во время генерации пришло новое сообщение — по желанию отменяем генерацию
         if cancel_on_new_msg:
-            task = inflight_tasks.get(message.chat.id)
+            task = rt.inflight_task
             if task and not task.done():
-                now = time.monotonic()
                 # Дебаунс отмены
-                last_fire = debounce_timers.get(message.chat.id, 0)
+                last_fire = rt.last_cancel_at
                 if (now - last_fire)*1000 >= batch_debounce_cancel_ms:
                     # Проверяем окно частых отмен
-                    ev_list = cancel_events.setdefault(message.chat.id, [])
-                    ev_list.append(now)
-                    # чистим просроченные
-                    cancel_events[message.chat.id] = [t for t in ev_list if now - t <= batch_cancel_window_sec]
-                    if len(cancel_events[message.chat.id]) >= 2:
+                    ev = rt.cancel_events
+                    ev.append(now)
+                    # чистим просроченные с головы: события упорядочены по времени
+                    while ev and now - ev[0] > batch_cancel_window_sec:
+                        ev.popleft()
+                    if len(ev) >= 2:
                         # Вошли в бурст отмен — возможно пропускаем отмену в cooldown период
-                        last_two = cancel_events[message.chat.id][-2]
+                        last_two = ev[-2]
                         if now - last_two < batch_cancel_window_sec:
                             # Если уже в cooldown — не отменяем
                             if now - last_two < batch_cancel_window_sec and (now - last_fire) < batch_cancel_cooldown_sec:
-                                get_logger().info(
+                                log.info(
                                     "buffer_cancel_skipped",
-                                    chat_id=message.chat.id,
                                     reason="cooldown",
-                                    recent_cancels=len(cancel_events[message.chat.id]),
+                                    recent_cancels=len(ev),
                                 )
                             else:
                                 task.cancel()
-                                debounce_timers[message.chat.id] = now
-                                get_logger().info(
+                                rt.last_cancel_at = now
+                                log.info(
                                     "buffer_cancel_attempt",
-                                    chat_id=message.chat.id,
                                     reason="burst_cancel",
-                                    recent_cancels=len(cancel_events[message.chat.id]),
+                                    recent_cancels=len(ev),
                                 )
                         else:
                             task.cancel()
-                            debounce_timers[message.chat.id] = now
-                            get_logger().info(
+                            rt.last_cancel_at = now
+                            log.info(
                                 "buffer_cancel_attempt",
-                                chat_id=message.chat.id,
                                 reason="second_in_window",
-                                recent_cancels=len(cancel_events[message.chat.id]),
+                                recent_cancels=len(ev),
                             )
                     else:
                         task.cancel()
-                        debounce_timers[message.chat.id] = now
-                        get_logger().info(
+                        rt.last_cancel_at = now
+                        log.info(
                             "buffer_cancel_attempt",
-                            chat_id=message.chat.id,
                             reason="first_cancel",
-                            recent_cancels=len(cancel_events[message.chat.id]),
+                            recent_cancels=len(ev),
                         )
                 else:
-                    get_logger().info(
+                    log.info(
                         "buffer_cancel_skipped",
-                        chat_id=message.chat.id,
                         reason="debounce",
                         since_last_ms=(now - last_fire)*1000,
                     )
-        # Health check: если таймер завершился (done) но буфер не пустой — перезапускаем
-        existing_task = buffer_tasks.get(message.chat.id)
-        if existing_task and existing_task.done():
-            get_logger().warning(
+        state = rt.buffer
+        if state is None:
+            state = rt.buffer = BufferState()
+        # Health check: если таймер завершился (done) но буфер остался — перезапускаем
+        if state.task and state.task.done():
+            log.warning(
                 "buffer_timer_zombie_detected",
-                chat_id=message.chat.id,
-                had_exception=bool(existing_task.exception()) if hasattr(existing_task, 'exception') else None,
+                had_exception=bool(state.task.exception()) if not state.task.cancelled() else None,
             )
-            buffer_tasks.pop(message.chat.id, None)
-        buf = message_buffers.setdefault(message.chat.id, [])
-        buf.append(message)
-        get_logger().info(
+            state.task = None
+        state.append(message, now)
+        log.info(
             "buffer_append",
-            chat_id=message.chat.id,
-            size=len(buf),
+            size=len(state),
             max=batch_max_messages,
             text_preview=(message.text or "")[:80],
         )
-        last_message_ts[message.chat.id] = time.monotonic()
-        # Лимит — немедленный flush
-        if len(buf) >= batch_max_messages:
-            if task := buffer_tasks.get(message.chat.id):
-                task.cancel()
-                with contextlib.suppress(Exception):
-                    await task
-            if use_queue:
-                msgs = message_buffers.get(message.chat.id, [])
-                if msgs:
-                    base = msgs[-1]
-                    combined_text = " \n".join(m.text or "" for m in msgs)
-                    get_logger().info(
-                        "buffer_flush",
-                        chat_id=message.chat.id,
-                        count=len(msgs),
-                        reason="max_messages",
-                        total_chars=len(combined_text),
-                    )
-                    message_buffers[message.chat.id] = []
-                    await _enqueue_incoming(base, combined_text, media=None, source="batch")
-            else:
-                await flush_buffer(message.chat.id)
-            return
-        if message.chat.id not in buffer_tasks:
-            buffer_tasks[message.chat.id] = asyncio.create_task(schedule_buffer_send(message.chat.id))
-            get_logger().info("buffer_timer_created", chat_id=message.chat.id)
-
-    @app.on_message((filters.voice | filters.audio) & ~filters.me)
+        # Окно тишины таймер пересчитает сам по last_at; будим его только при заполнении буфера
+        if len(state) >= batch_max_messages:
+            state.full.set()
+        if state.task is None:
+            state.task = asyncio.create_task(schedule_buffer_send(cid, state))
+            buffer_timers.add(state.task)
+            state.task.add_done_callback(buffer_timers.discard)
+            log.info("buffer_timer_created")
+
+    # Обрабатываем только адресованные нам сообщения
+    @app.on_message((filters.voice | filters.audio) & incoming)
     async def handle_voice(_: Client, message: Message):
-        # Обрабатываем только адресованные нам сообщения
-        if not my_id_box:
-            me = await app.get_me()
-            my_id_box["id"] = me.id
-        if not _is_for_me(message, my_id_box["id"]):
-            return
-        if message.from_user and getattr(message.from_user, "is_bot", False):
-            return
-
         # Индикация "печатает" пока обрабатываем
         # Скачиваем в память и загружаем на наш backend /upload
+        cid = message.chat.id
+        rt = chats[cid]
         try:
             # Mark photo processing in-flight for this chat to let following text attach as caption
-            photo_inflight[message.chat.id] = time.monotonic()
+            rt.photo_inflight_at = time.monotonic()
+            rt.photo_ready.clear()
             bio: BytesIO = await message.download(in_memory=True)  # type: ignore[assignment]
             # Определяем имя и mime
             mime: str = "application/octet-stream"
             filename: str = "audio.bin"
             duration: Optional[int] = None
             voice_file_id: Optional[str] = None
-            if message.voice:
-                filename = "voice.ogg"
-                mime = getattr(message.voice, "mime_type", None) or "audio/ogg"
-                duration = getattr(message.voice, "duration", None)
-                voice_file_id = getattr(message.voice, "file_id", None)
-            elif message.audio:
-                filename = message.audio.file_name or "audio.mp3"
-                mime = getattr(message.audio, "mime_type", None) or "audio/mpeg"
-                duration = getattr(message.audio, "duration", None)
-                voice_file_id = getattr(message.audio, "file_id", None)
-
-            upload_url = str(settings.public_base_url).rstrip("/") + "/upload"
+            if v := message.voice:
+                filename, mime, duration, voice_file_id = "voice.ogg", v.mime_type or "audio/ogg", v.duration, v.file_id
+            elif a := message.audio:
+                filename, mime, duration, voice_file_id = a.file_name or "audio.mp3", a.mime_type or "audio/mpeg", a.duration, a.file_id
+
             try:
-                async with httpx.AsyncClient(timeout=httpx.Timeout(60.0)) as hc:
-                    files = {"file": (filename, bio.getvalue(), mime)}
-                    resp = await hc.post(upload_url, files=files)
-                    resp.raise_for_status()
-                    data = resp.json()
-                    audio_url = data.get("url")
-                    if not audio_url:
-                        raise RuntimeError("empty upload url")
+                # Отдаём сам BytesIO: multipart читает его по частям, без копии через getvalue()
+                bio.seek(0)
+                files = {"file": (filename, bio, mime)}
+                resp = await upload_client.post(upload_url, files=files)
+                resp.raise_for_status()
+                data = resp.json()
+                audio_url = data.get("url")
+                if not audio_url:
+                    raise RuntimeError("empty upload url")
             except Exception:
                 # Тихо игнорируем (suppress)
                 return
+            finally:
+                # Байты уже на backend — освобождаем буфер до (возможно долгой) генерации ответа
+                bio.close()
 
             # Отправляем в общий поток с медиаметаданными; текст – плейсхолдер
             media = {
@@ -797,62 +863,60 @@ async def main() -> None:
                 await _process_single(app, shim, message, "[voice_message]", media, disable_local_typing=True)
         finally:
             # Clear in-flight flag
-            photo_inflight.pop(message.chat.id, None)
+            rt.photo_inflight_at = None
+            rt.photo_ready.set()
 
-    @app.on_message(((filters.photo) | (filters.document)) & ~filters.me)
+    # Обрабатываем только адресованные нам сообщения
+    @app.on_message(((filters.photo) | (filters.document)) & incoming)
     async def handle_photo(_: Client, message: Message):
-        # Обрабатываем только адресованные нам сообщения
-        if not my_id_box:
-            me = await app.get_me()
-            my_id_box["id"] = me.id
-        if not _is_for_me(message, my_id_box["id"]):
-            return
-        if message.from_user and getattr(message.from_user, "is_bot", False):
-            return
-
-        # Если это документ, но не изображение — пропускаем
-        if getattr(message, "document", None) and getattr(message.document, "mime_type", None):
-            if not str(message.document.mime_type).startswith("image/"):
+        # Документ проверяем до скачивания: не изображение или слишком большой — пропускаем
+        doc = message.document
+        if doc:
+            if not (doc.mime_type or "").startswith("image/"):
+                return
+            if doc.file_size and doc.file_size > max_upload_bytes:
+                get_logger().info("media_skipped_too_large", chat_id=message.chat.id, size=doc.file_size, limit=max_upload_bytes)
                 return
 
         # Скачиваем изображение (Pyrogram сам возьмёт лучший размер для photo)
+        cid = message.chat.id
+        rt = chats[cid]
         try:
+            # Mark photo processing in-flight so that a follow-up text waits and attaches as caption
+            rt.photo_inflight_at = time.monotonic()
+            # Фото может открыть новый буфер в БД — сбрасываем отрицательный кэш
+            no_pending_photo.pop(cid, None)
+            rt.photo_ready.clear()
             bio: BytesIO = await message.download(in_memory=True)  # type: ignore[assignment]
             mime: str = "image/jpeg"
             filename: str = "photo.jpg"
             width = None
             height = None
             image_file_id = None
-            if getattr(message, "photo", None):
-                p = message.photo
-                try:
-                    width = getattr(p, "width", None)
-                    height = getattr(p, "height", None)
-                except Exception:
-                    pass
-                try:
-                    image_file_id = getattr(p, "file_id", None)
-                except Exception:
-                    image_file_id = None
-            if getattr(message, "document", None) and getattr(message.document, "mime_type", None):
+            if p := message.photo:
+                width, height, image_file_id = p.width, p.height, p.file_id
+            if doc:
                 # document тут гарантированно image/* благодаря проверке выше
-                mime = message.document.mime_type
-                filename = message.document.file_name or filename
-                image_file_id = message.document.file_id
+                mime = doc.mime_type
+                filename = doc.file_name or filename
+                image_file_id = doc.file_id
 
-            upload_url = str(settings.public_base_url).rstrip("/") + "/upload"
             try:
-                async with httpx.AsyncClient(timeout=httpx.Timeout(60.0)) as hc:
-                    files = {"file": (filename, bio.getvalue(), mime)}
-                    resp = await hc.post(upload_url, files=files)
-                    resp.raise_for_status()
-                    data = resp.json()
-                    image_url = data.get("url")
-                    if not image_url:
-                        raise RuntimeError("empty upload url")
+                # Отдаём сам BytesIO: multipart читает его по частям, без копии через getvalue()
+                bio.seek(0)
+                files = {"file": (filename, bio, mime)}
+                resp = await upload_client.post(upload_url, files=files)
+                resp.raise_for_status()
+                data = resp.json()
+                image_url = data.get("url")
+                if not image_url:
+                    raise RuntimeError("empty upload url")
             except Exception:
                 # Тихо игнорируем (suppress)
                 return
+            finally:
+                # Байты уже на backend — освобождаем буфер до (возможно долгой) генерации ответа
+                bio.close()
 
             media = {
                 "origin": "photo",
@@ -873,10 +937,15 @@ async def main() -> None:
             else:
                 await _process_single(app, shim, message, cap, media, disable_local_typing=True, use_buffer=True)
         finally:
-            pass
+            # Буфер записан (или загрузка сорвалась) — будим ждущие тексты
+            rt.photo_inflight_at = None
+            no_pending_photo.pop(cid, None)
+            rt.photo_ready.set()
 
     print("[userbot] starting... press Ctrl+C to stop")
     await app.start()
+    # start() уже запросил get_me() до запуска диспетчера — берём готовое значение без лишнего RPC
+    my_id = app.me.id
     # Отметим все новые чаты как proactive_via_userbot=True (если нужно поведение проактивов через userbot)
     async def mark_chat_state(chat_id: int):
         async with session_scope() as session:
@@ -886,131 +955,183 @@ async def main() -> None:
 
     # Периодический воркер отправки outbox
     async def outbox_worker():
+        # Параллельные отправки в разные чаты (с оглядкой на flood-лимиты Telegram)
+        send_sem = asyncio.Semaphore(int(os.getenv("USERBOT_OUTBOX_SEND_CONCURRENCY", "4")))
         while True:
             await asyncio.sleep(outbox_poll_seconds)
             try:
                 async with session_scope() as session:
-                    q = await session.execute(
-                        ProactiveOutbox.__table__.select().where(ProactiveOutbox.sent_at.is_(None)).order_by(ProactiveOutbox.id).limit(20)
+                    # Забираем пачку одним UPDATE ... RETURNING: строки под SKIP LOCKED не достанутся
+                    # параллельному воркеру, attempts растёт сразу при захвате
+                    outbox = ProactiveOutbox.__table__
+                    claimable = (
+                        select(outbox.c.id)
+                        .where(outbox.c.sent_at.is_(None))
+                        .order_by(outbox.c.id)
+                        .limit(20)
+                        .with_for_update(skip_locked=True)
+                        .cte("claimable")
                     )
-                    rows = q.fetchall()
+                    rows = (
+                        await session.execute(
+                            outbox.update()
+                            .where(outbox.c.id.in_(select(claimable.c.id)))
+                            .values(attempts=outbox.c.attempts + 1)
+                            .returning(outbox.c.id, outbox.c.chat_id, outbox.c.text, outbox.c.meta_json)
+                        )
+                    ).fetchall()
                     if not rows:
                         continue
-                    for row in rows:
-                        row_obj = ProactiveOutbox(**row._mapping)
-                        try:
-                            await app.send_message(row_obj.chat_id, row_obj.text)
-                            # Логируем как assistant message для целостности истории
-                            session.add(AssistantMessage(chat_id=row_obj.chat_id, text=row_obj.text, meta_json=row_obj.meta_json))
-                            # Обновляем state.last_assistant_at
-                            state = await session.get(ChatState, row_obj.chat_id)
-                            if state:
-                                state.last_assistant_at = utcnow()
-                            # mark sent
-                            await session.execute(
-                                ProactiveOutbox.__table__.update().where(ProactiveOutbox.id == row_obj.id).values(sent_at=utcnow(), attempts=row_obj.attempts + 1)
-                            )
-                        except Exception:
-                            # increment attempts
-                            await session.execute(
-                                ProactiveOutbox.__table__.update().where(ProactiveOutbox.id == row_obj.id).values(attempts=row_obj.attempts + 1)
-                            )
+                    sent_ids: list[int] = []
+                    sent_chat_ids: set[int] = set()
+                    assistant_rows: list[dict] = []
+                    by_chat: dict[int, list] = {}
+                    for row in sorted(rows, key=lambda r: r.id):
+                        by_chat.setdefault(row.chat_id, []).append(row)
+
+                    async def send_chat(chat_rows: list):
+                        # Внутри чата — строго по порядку id, чаты между собой — параллельно
+                        async with send_sem:
+                            for row in chat_rows:
+                                try:
+                                    sent = await app.send_message(row.chat_id, row.text)
+                                except Exception:
+                                    # Не отправилось — останется с sent_at IS NULL до следующего прохода
+                                    continue
+                                # Логируем как assistant message для целостности истории
+                                assistant_rows.append(
+                                    {"chat_id": row.chat_id, "text": row.text, "meta_json": row.meta_json, "tg_message_id": sent.id}
+                                )
+                                sent_ids.append(row.id)
+                                sent_chat_ids.add(row.chat_id)
+
+                    async with asyncio.TaskGroup() as tg:
+                        for chat_rows in by_chat.values():
+                            tg.create_task(send_chat(chat_rows))
+                    if sent_ids:
+                        now_utc = utcnow()
+                        await session.execute(insert(AssistantMessage), assistant_rows)
+                        # Отметки отправки и last_assistant_at — по одному UPDATE на пачку
+                        await session.execute(outbox.update().where(outbox.c.id.in_(sent_ids)).values(sent_at=now_utc))
+                        await session.execute(
+                            ChatState.__table__.update()
+                            .where(ChatState.chat_id.in_(list(sent_chat_ids)))
+                            .values(last_assistant_at=now_utc)
+                        )
             except Exception:
                 # глушим, чтобы воркер не падал
                 pass
 
-    asyncio.create_task(outbox_worker())
+    _spawn_worker(outbox_worker(), "outbox")
 
     async def tasks_worker():
         if not use_queue:
             return
         lease_sec = int(float(os.getenv("TASK_LEASE_SECONDS", "60")))
         heartbeat_every = max(10, int(float(os.getenv("TASK_HEARTBEAT_SECONDS", "30"))))
+        # Специализация воркера: брать только задачи с tag по префиксу (например chat:), пусто — все
+        tag_prefix = os.getenv("USERBOT_TASK_TAG_PREFIX") or None
         last_hb: dict[int, float] = {}
-        while True:
-            await asyncio.sleep(0.5)
-            try:
-                async with session_scope() as session:
-                    tasks = await lease_tasks(session, kinds=["incoming_user_message"], limit=5, lease_seconds=lease_sec)
-                    if not tasks:
-                        continue
-                    get_logger().info("task_lease_batch", count=len(tasks))
-                    for t in tasks:
-                        payload = t.payload_json
-                        start_monotonic = time.monotonic()
-                        logger = get_logger().bind(task_id=t.id, attempt=t.attempts, chat_id=payload.get("chat_id"), trace_id=payload.get("trace_id"))
-                        # Дополнительная диагностика сна чата
-                        sleep_info = {}
-                        try:
-                            state = await session.get(ChatState, payload.get("chat_id"))
-                            if state and getattr(state, 'sleep_until', None):
-                                now_utc = utcnow()
-                                if state.sleep_until > now_utc:  # type: ignore[operator]
-                                    remaining = int((state.sleep_until - now_utc).total_seconds())  # type: ignore[arg-type]
-                                    # Попытка вывести причину: смотрим последние события абьюза
-                                    from sqlalchemy import select
-                                    ev_q = select(Event).where(Event.chat_id==payload.get("chat_id"), Event.kind.in_(["abuse_auto_block","abuse_detected"])).order_by(Event.id.desc()).limit(1)
-                                    ev = (await session.execute(ev_q)).scalars().first()
-                                    reason = None
-                                    if ev:
-                                        if ev.kind == "abuse_auto_block":
-                                            reason = "abuse_auto_block"
-                                        elif ev.kind == "abuse_detected":
-                                            reason = "abuse_detected"
-                                    if reason is None:
-                                        reason = "night_mode_or_manual"
-                                    sleep_info = {"sleeping": True, "remaining_sec": remaining, "reason": reason}
-                        except Exception:
-                            pass
-                        logger.info("task_start", kind=t.kind, **sleep_info)
-                        try:
-                            await process_user_text(
-                                shim,
-                                session,
-                                chat_id=payload["chat_id"],
-                                chat_type=payload.get("chat_type", "private"),
-                                user_id=payload.get("user_id"),
-                                username=payload.get("username"),
-                                lang=payload.get("lang"),
-                                text=payload.get("text", ""),
-                                media=payload.get("media"),
-                                settings=settings,
-                                trace_id=payload.get("trace_id"),
-                                tg_message_id=payload.get("telegram_message_id"),
-                            )
-                            await complete(session, t.id, status="done")
-                            metrics.inc("tasks_processed_total", labels={"kind": t.kind, "status": "done"})
-                            metrics.observe("task_processing_seconds", time.monotonic() - start_monotonic, labels={"kind": t.kind})
-                            logger.info("task_done", kind=t.kind)
-                        except Exception as e:
-                            # Классификация серверных ошибок n8n по тексту (исключение прокинуто из N8NServerError)
-                            is_5xx = "n8n 5xx" in str(e)
-                            if is_5xx and t.attempts < 5:
-                                # Возвращаем задачу в pending с простым backoff через sleep перед повторным лизингом
-                                await return_to_pending(session, [t.id])
-                                metrics.inc("tasks_retried_total", labels={"kind": t.kind})
-                                logger.warning("task_requeue", reason="n8n_5xx", attempts=t.attempts)
-                            else:
-                                await complete(session, t.id, status="failed", error=str(e)[:4000])
-                                metrics.inc("tasks_processed_total", labels={"kind": t.kind, "status": "failed"})
-                                logger.error("task_fail", error_class="n8n_5xx" if is_5xx else "exception", error=str(e))
-                        else:
-                            last_hb.pop(t.id, None)
-                # Heartbeat processed tasks still running (в нашей реализации процесс сразу завершает, heartbeat нужен для длинных задач — оставлено заделом)
-                now_mono = time.monotonic()
-                to_hb: list[int] = []
-                for tid, ts in list(last_hb.items()):
-                    if now_mono - ts >= heartbeat_every:
-                        to_hb.append(tid)
-                        last_hb[tid] = now_mono
-                if to_hb:
+        # Просыпаемся по NOTIFY (enqueue_*, return_to_pending, watchdog); слушатель сам переподписывается
+        # при обрыве. Редкий опрос — страховка на время переподключения и для не-Postgres
+        idle_poll_sec = float(os.getenv("TASK_IDLE_POLL_SECONDS", "5"))
+        wake = asyncio.Event()
+        # Логгер воркера создаём один раз; контекст задачи навешиваем через bind
+        wlog = get_logger()
+        async with new_task_listener(wake) as listening:
+            wlog.info("tasks_worker_start", listen_notify=listening, idle_poll=idle_poll_sec)
+            while True:
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(wake.wait(), timeout=idle_poll_sec)
+                wake.clear()
+                try:
                     async with session_scope() as session:
-                        for tid in to_hb:
-                            await heartbeat(session, tid, lease_seconds=lease_sec)
-            except Exception:
-                pass
+                        tasks = await lease_tasks(session, kinds=["incoming_user_message"], limit=5, lease_seconds=lease_sec, tag_prefix=tag_prefix)
+                        if not tasks:
+                            continue
+                        # Пачка полная — в очереди, вероятно, есть ещё: следующий проход без ожидания
+                        if len(tasks) >= 5:
+                            wake.set()
+                        wlog.info("task_lease_batch", count=len(tasks))
+                        # Часы читаем на границах задач: конец одной — начало следующей и момент heartbeat-проверки
+                        now_mono = time.monotonic()
+                        for t in tasks:
+                            payload = t.payload_json
+                            start_monotonic = now_mono
+                            logger = wlog.bind(task_id=t.id, attempt=t.attempts, chat_id=payload.get("chat_id"), trace_id=payload.get("trace_id"))
+                            # Дополнительная диагностика сна чата
+                            sleep_info = {}
+                            try:
+                                state = await session.get(ChatState, payload.get("chat_id"))
+                                if state and getattr(state, 'sleep_until', None):
+                                    now_utc = utcnow()
+                                    if state.sleep_until > now_utc:  # type: ignore[operator]
+                                        remaining = int((state.sleep_until - now_utc).total_seconds())  # type: ignore[arg-type]
+                                        # Попытка вывести причину: смотрим последние события абьюза
+                                        from sqlalchemy import select
+                                        ev_q = select(Event).where(Event.chat_id==payload.get("chat_id"), Event.kind.in_(["abuse_auto_block","abuse_detected"])).order_by(Event.id.desc()).limit(1)
+                                        ev = (await session.execute(ev_q)).scalars().first()
+                                        reason = None
+                                        if ev:
+                                            if ev.kind == "abuse_auto_block":
+                                                reason = "abuse_auto_block"
+                                            elif ev.kind == "abuse_detected":
+                                                reason = "abuse_detected"
+                                        if reason is None:
+                                            reason = "night_mode_or_manual"
+                                        sleep_info = {"sleeping": True, "remaining_sec": remaining, "reason": reason}
+                            except Exception:
+                                pass
+                            logger.info("task_start", kind=t.kind, **sleep_info)
+                            try:
+                                await process_user_text(
+                                    shim,
+                                    session,
+                                    chat_id=payload["chat_id"],
+                                    chat_type=payload.get("chat_type", "private"),
+                                    user_id=payload.get("user_id"),
+                                    username=payload.get("username"),
+                                    lang=payload.get("lang"),
+                                    text=payload.get("text", ""),
+                                    media=payload.get("media"),
+                                    settings=settings,
+                                    trace_id=payload.get("trace_id"),
+                                    tg_message_id=payload.get("telegram_message_id"),
+                                )
+                                await complete(session, t.id, status="done")
+                                metrics.inc("tasks_processed_total", labels={"kind": t.kind, "status": "done"})
+                                now_mono = time.monotonic()
+                                metrics.observe("task_processing_seconds", now_mono - start_monotonic, labels={"kind": t.kind})
+                                logger.info("task_done", kind=t.kind)
+                            except Exception as e:
+                                # Классификация серверных ошибок n8n по тексту (исключение прокинуто из N8NServerError)
+                                is_5xx = "n8n 5xx" in str(e)
+                                if is_5xx and t.attempts < 5:
+                                    # Возвращаем задачу в pending с простым backoff через sleep перед повторным лизингом
+                                    await return_to_pending(session, [t.id])
+                                    metrics.inc("tasks_retried_total", labels={"kind": t.kind})
+                                    logger.warning("task_requeue", reason="n8n_5xx", attempts=t.attempts)
+                                else:
+                                    await complete(session, t.id, status="failed", error=str(e)[:4000])
+                                    metrics.inc("tasks_processed_total", labels={"kind": t.kind, "status": "failed"})
+                                    logger.error("task_fail", error_class="n8n_5xx" if is_5xx else "exception", error=str(e))
+                                now_mono = time.monotonic()
+                            else:
+                                last_hb.pop(t.id, None)
+                    # Heartbeat processed tasks still running (в нашей реализации процесс сразу завершает, heartbeat нужен для длинных задач — оставлено заделом)
+                    to_hb: list[int] = []
+                    for tid, ts in last_hb.items():
+                        if now_mono - ts >= heartbeat_every:
+                            to_hb.append(tid)
+                            last_hb[tid] = now_mono
+                    if to_hb:
+                        async with session_scope() as session:
+                            for tid in to_hb:
+                                await heartbeat(session, tid, lease_seconds=lease_sec)
+                except Exception:
+                    pass
 
-    asyncio.create_task(tasks_worker())
+    _spawn_worker(tasks_worker(), "tasks")
 
     async def watchdog_worker():
         if not use_queue:
@@ -1030,103 +1151,104 @@ async def main() -> None:
             except Exception:
                 pass
 
-    asyncio.create_task(watchdog_worker())
+    _spawn_worker(watchdog_worker(), "watchdog")
 
     async def recovery_worker():
         if not use_queue:
             return
         # Одноразовый прогон после старта
         recovery_limit = int(float(os.getenv("RECOVERY_HISTORY_LIMIT", "500")))
-        try:
-            me = await app.get_me()
-            my_id = me.id
-        except Exception:
-            return
         # Соберём чаты где есть state или сообщения (упрощённо: все chat_ids из ChatState)
         from sqlalchemy import select as _select
         async with session_scope() as session:
             rows = (await session.execute(_select(ChatState.chat_id))).all()
             chat_ids = [r[0] for r in rows]
-        for cid in chat_ids:
-            try:
-                # Найти последний сохранённый tg_message_id
-                async with session_scope() as session:
-                    from sqlalchemy import func as _f
-                    from app.db.models import Message as _Msg
-                    max_row = (await session.execute(_select(_f.max(_Msg.tg_message_id)).where(_Msg.chat_id == cid))).scalar()
-                    last_saved = max_row or 0
-                missing: list[Message] = []
-                count = 0
-                async for h in app.get_chat_history(cid, limit=recovery_limit):
-                    # Pyrogram возвращает от новых к старым. Останавливаемся когда дошли до сохранённого
-                    if h.id <= last_saved:
-                        break
-                    if h.from_user and h.from_user.id == my_id:
-                        continue  # пропускаем собственные ответы
-                    if not (h.text or h.caption):
-                        continue
-                    missing.append(h)
-                    count += 1
-                    if count >= recovery_limit:
-                        break
-                if missing:
-                    metrics.inc("recovery_gap_messages_total", value=len(missing), labels={"kind": "incoming_user_message"})
-                    for m in sorted(missing, key=lambda x: x.id):
-                        text_val = m.text or m.caption or ""
-                        payload = {
-                            "telegram_message_id": m.id,
-                            "chat_id": cid,
-                            "chat_type": _chat_type_str(m.chat.type if getattr(m, 'chat', None) else None),
-                            "user_id": getattr(m.from_user, 'id', None) if m.from_user else None,
-                            "username": getattr(m.from_user, 'username', None) if m.from_user else None,
-                            "lang": getattr(m.from_user, 'language_code', None) if m.from_user else None,
-                            "text": text_val,
-                            "media": None,
-                        }
-                        async with session_scope() as session:
-                            dedup = f"recovery:{cid}:{m.id}"
-                            await enqueue_task(session, kind="incoming_user_message", payload=payload, priority=90, dedup_key=dedup)
-                            metrics.inc("tasks_created_total", labels={"kind": "incoming_user_message", "source": "recovery"})
-                # Assistant backfill (берём последние сообщения userbot'а если их нет в БД)
+        from sqlalchemy import func as _f
+        from app.db.models import Message as _Msg
+        # Несколько чатов параллельно: ожидание ответов Telegram перекрывается, сессии БД — короткие, на каждый чат
+        recovery_sem = asyncio.Semaphore(int(os.getenv("RECOVERY_CONCURRENCY", "8")))
+
+        async def recover_chat(cid: int):
+            async with recovery_sem:
                 try:
+                    # Последние сохранённые tg_message_id (входящие и наши) и уже известные id ответов — одной сессией
                     async with session_scope() as session:
-                        from sqlalchemy import select as _select2
-                        from app.db.models import AssistantMessage as _A
+                        last_saved = (
+                            await session.execute(_select(_f.max(_Msg.tg_message_id)).where(_Msg.chat_id == cid))
+                        ).scalar() or 0
                         existing_a_ids = set(
-                            r[0]
-                            for r in (
+                            (
                                 await session.execute(
-                                    _select2(_A.tg_message_id).where(_A.chat_id == cid, _A.tg_message_id.is_not(None))
+                                    _select(AssistantMessage.tg_message_id).where(
+                                        AssistantMessage.chat_id == cid, AssistantMessage.tg_message_id.is_not(None)
+                                    )
                                 )
-                            ).all()
+                            ).scalars()
                         )
+                    last_a_saved = max(existing_a_ids, default=0)
+                    # Один проход по истории (от новых к старым): сразу раскладываем входящие и наши сообщения.
+                    # Дальше обеих границ идти незачем — остальное уже в БД
+                    stop_at = min(last_saved, last_a_saved)
+                    missing: list[Message] = []
                     a_missing: list[Message] = []
-                    count_a = 0
                     async for h in app.get_chat_history(cid, limit=recovery_limit):
+                        if h.id <= stop_at:
+                            break
                         if not (h.text or h.caption):
                             continue
-                        if not (h.from_user and h.from_user.id == my_id):
-                            continue
-                        if h.id in existing_a_ids:
-                            continue
-                        a_missing.append(h)
-                        count_a += 1
-                        if count_a >= recovery_limit:
-                            break
-                    if a_missing:
-                        metrics.inc("recovery_gap_messages_total", value=len(a_missing), labels={"kind": "assistant_backfill"})
+                        if h.from_user and h.from_user.id == my_id:
+                            if h.id not in existing_a_ids:
+                                a_missing.append(h)
+                        elif h.id > last_saved:
+                            missing.append(h)
+                    if missing:
+                        metrics.inc("recovery_gap_messages_total", value=len(missing), labels={"kind": "incoming_user_message"})
+                        items = []
+                        for m in sorted(missing, key=lambda x: x.id):
+                            payload = {
+                                "telegram_message_id": m.id,
+                                "chat_id": cid,
+                                "chat_type": _chat_type_str(m.chat.type if m.chat else None),
+                                "user_id": m.from_user.id if m.from_user else None,
+                                "username": m.from_user.username if m.from_user else None,
+                                "lang": m.from_user.language_code if m.from_user else None,
+                                "text": m.text or m.caption or "",
+                                "media": None,
+                            }
+                            items.append((payload, f"recovery:{cid}:{m.id}"))
+                        # Один INSERT ... ON CONFLICT (dedup_key) DO NOTHING вместо сессии на каждое сообщение
                         async with session_scope() as session:
-                            for am in sorted(a_missing, key=lambda x: x.id):
-                                session.add(AssistantMessage(chat_id=cid, text=am.text or am.caption or "", meta_json={"recovered": True}))
+                            await enqueue_tasks(session, kind="incoming_user_message", items=items, priority=90, tag=f"chat:{cid}")
+                        metrics.inc("tasks_created_total", value=len(items), labels={"kind": "incoming_user_message", "source": "recovery"})
+                    # Assistant backfill (наши сообщения, которых нет в БД)
+                    if a_missing:
+                        try:
+                            metrics.inc("recovery_gap_messages_total", value=len(a_missing), labels={"kind": "assistant_backfill"})
+                            # Одним executemany; tg_message_id сохраняем, чтобы следующий прогон не дублировал эти ответы
+                            async with session_scope() as session:
+                                await session.execute(
+                                    insert(AssistantMessage),
+                                    [
+                                        {"chat_id": cid, "text": am.text or am.caption or "", "meta_json": {"recovered": True}, "tg_message_id": am.id}
+                                        for am in sorted(a_missing, key=lambda x: x.id)
+                                    ],
+                                )
+                        except Exception:
+                            pass
                 except Exception:
-                    pass
-            except Exception:
-                continue
+                    return
 
-    asyncio.create_task(recovery_worker())
+        await asyncio.gather(*(recover_chat(c) for c in chat_ids), return_exceptions=True)
+
+    _spawn_worker(recovery_worker(), "recovery")
     try:
         await idle()
     finally:
+        # Отменяем воркеры, незавершённые входящие, таймеры пакетов и генерации и дожидаемся их cleanup до остановки клиента
+        pending = [*workers, *incoming_tasks, *buffer_timers, *gen_tasks]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
         await app.stop()
 
 
@@ -1,13 +1,17 @@
 import asyncio
 import argparse
+import sys
 from typing import List
 
+from sqlalchemy.orm import load_only
+
 from app.db.base import session_scope
 from app.db.models import ChatState, AssistantMessage, ProactiveOutbox
 from app.bot.schemas.n8n_io import ChatInfo, Context, N8nRequest
-from app.bot.services.n8n_client import call_n8n
+from app.bot.services.n8n_client import call_n8n_raw
 from app.bot.services.history import fetch_recent_history
 from app.config.settings import get_settings
+from app.utils.async_utils import concurrent_map
 from app.utils.time import utcnow
 
 # Optional direct send via bot
@@ -16,12 +20,23 @@ try:
 except Exception:  # pragma: no cover
     Bot = None  # type: ignore
 
-INTENTS_ALL = [
+INTENTS_ALL = (
     "proactive_morning",
     "proactive_evening",
     "proactive_reengage",
     "proactive_generic",
-]
+)
+_INTENTS_SET = frozenset(INTENTS_ALL)
+
+# mimic trimming behaviour: these intents go to n8n without chat history
+TRIM_INTENTS = frozenset({"proactive_morning", "proactive_evening", "proactive_reengage"})
+
+# intent -> ChatState timestamp the scheduler updates after sending it
+_INTENT_TS_FIELD = {
+    "proactive_morning": "last_morning_sent_at",
+    "proactive_evening": "last_goodnight_sent_at",
+    "proactive_reengage": "last_reengage_sent_at",
+}
 
 
 def build_parser():
@@ -42,25 +57,36 @@ def build_parser():
     return p
 
 
-async def generate_one(session, chat_state: ChatState, intent: str, settings, use_history_limit: int):
-    persona = chat_state.persona_key or "nika"
-    # mimic trimming behaviour: morning/evening/reengage -> trimmed; generic -> keep history
-    trim = intent in {"proactive_morning", "proactive_evening", "proactive_reengage"}
-    if trim:
-        history = []
-    else:
-        history = await fetch_recent_history(session, chat_state.chat_id, limit_pairs=use_history_limit, persona=persona)
-    ctx = Context(
-        history=history,
-        last_user_msg_at=chat_state.last_user_msg_at,
-        last_assistant_at=chat_state.last_assistant_at,
-    )
-    req = N8nRequest(
-        intent=intent,
+def build_payloads(chat_state: ChatState, persona: str, intents: List[str], history: list) -> List[dict]:
+    """Serialize the n8n request once and derive one payload per intent.
+
+    Intents only differ in `intent` and (for trimmed ones) an empty history,
+    so a shallow copy of the dumped base is enough.
+    """
+
+    base = N8nRequest(
+        intent="proactive_generic",
         chat=ChatInfo(chat_id=chat_state.chat_id, user_id=None, persona=persona, memory_rev=chat_state.memory_rev),
-        context=ctx,
-    )
-    resp = await call_n8n(req)
+        context=Context(
+            history=history,
+            last_user_msg_at=chat_state.last_user_msg_at,
+            last_assistant_at=chat_state.last_assistant_at,
+        ),
+    ).model_dump(mode="json")
+    trimmed_ctx = {**base["context"], "history": []}
+    return [
+        {**base, "intent": intent, "context": trimmed_ctx if intent in TRIM_INTENTS else base["context"]}
+        for intent in intents
+    ]
+
+
+async def generate_one(payload: dict):
+    """Network half: call n8n for one prepared payload.
+
+    Touches no session, so several intents can run concurrently.
+    """
+
+    resp = await call_n8n_raw(payload)
     return resp.reply, resp.meta.model_dump()
 
 
@@ -68,9 +94,13 @@ async def main():
     args = build_parser().parse_args()
     intents: List[str]
     if args.intents == "all":
-        intents = INTENTS_ALL
+        intents = list(INTENTS_ALL)
     else:
-        intents = [x.strip() for x in args.intents.split(",") if x.strip()]
+        # order-preserving dedup: a repeated intent would cost an extra n8n call
+        intents = list(dict.fromkeys(x.strip() for x in args.intents.split(",") if x.strip()))
+        unknown = [x for x in intents if x not in _INTENTS_SET]
+        if unknown:
+            raise SystemExit(f"Unknown intents: {', '.join(unknown)}")
     settings = get_settings()
 
     bot = None
@@ -81,62 +111,110 @@ async def main():
             raise SystemExit("TELEGRAM_BOT_TOKEN missing for --direct mode")
         bot = Bot(token=settings.telegram_bot_token)
 
-    async with session_scope() as session:
-        state = await session.get(ChatState, args.chat)
-        if state is None:
-            raise SystemExit("ChatState not found. Send at least one message to the bot/userbot first.")
-        if args.force_userbot:
-            state.proactive_via_userbot = True
-        results = []
-        for intent in intents:
-            try:
-                text, meta = await generate_one(session, state, intent, settings, args.history)
-            except Exception as e:  # n8n failure
-                results.append((intent, f"ERROR: {e}", False))
-                continue
-            meta_full = {"intent": intent, **meta}
-            if args.dry_run:
-                results.append((intent, text, True))
-                continue
-            if bot and not state.proactive_via_userbot:
-                # immediate send via Bot
-                try:
-                    await bot.send_message(state.chat_id, text)
-                    session.add(AssistantMessage(chat_id=state.chat_id, text=text, meta_json=meta_full))
-                    state.last_assistant_at = utcnow()
-                    # update intent timestamps similar to scheduler
-                    if intent == "proactive_morning":
-                        state.last_morning_sent_at = utcnow()
-                    elif intent == "proactive_evening":
-                        state.last_goodnight_sent_at = utcnow()
-                    elif intent == "proactive_reengage":
-                        state.last_reengage_sent_at = utcnow()
-                    results.append((intent, text, True))
-                except Exception as e:
-                    results.append((intent, f"SEND ERROR: {e}", False))
-            else:
-                # enqueue for userbot outbox
-                session.add(
-                    ProactiveOutbox(chat_id=state.chat_id, intent=intent, text=text, meta_json=meta_full)
+    # close the bot's HTTP session on every exit path (SystemExit, DB errors, ...)
+    try:
+        async with session_scope() as session:
+            # only the columns this script reads or writes (ChatState is a wide row)
+            state = await session.get(
+                ChatState,
+                args.chat,
+                options=[
+                    load_only(
+                        ChatState.persona_key,
+                        ChatState.memory_rev,
+                        ChatState.proactive_via_userbot,
+                        ChatState.last_user_msg_at,
+                        ChatState.last_assistant_at,
+                        ChatState.last_morning_sent_at,
+                        ChatState.last_goodnight_sent_at,
+                        ChatState.last_reengage_sent_at,
+                    )
+                ],
+            )
+            if state is None:
+                raise SystemExit("ChatState not found. Send at least one message to the bot/userbot first.")
+            if args.force_userbot:
+                state.proactive_via_userbot = True
+            chat_id = state.chat_id
+            persona = state.persona_key or "nika"
+            # fetch history once, and only if some requested intent actually sends it
+            history = []
+            if any(i not in TRIM_INTENTS for i in intents):
+                history = await fetch_recent_history(session, chat_id, limit_pairs=args.history, persona=persona)
+            # n8n calls are independent -> run them concurrently; DB writes below stay serial
+            # (AsyncSession is not safe to share between tasks)
+            payloads = build_payloads(state, persona, intents, history)
+            generated = await concurrent_map(
+                (generate_one(payload) for payload in payloads),
+                return_exceptions=True,
+            )
+            texts = [outcome[0] for outcome in generated if not isinstance(outcome, BaseException)]
+
+            direct = bot is not None and not args.dry_run and not state.proactive_via_userbot
+            sent: list = [None] * len(texts)
+            if direct and texts:
+                # immediate send via Bot, all intents at once. Concurrent sends to one chat
+                # may arrive in any order - acceptable for this manual test; chain the
+                # awaits instead if the delivery order ever matters
+                sent = await concurrent_map(
+                    (bot.send_message(chat_id, text) for text in texts),
+                    return_exceptions=True,
                 )
-                # same timestamp updates
-                if intent == "proactive_morning":
-                    state.last_morning_sent_at = utcnow()
-                elif intent == "proactive_evening":
-                    state.last_goodnight_sent_at = utcnow()
-                elif intent == "proactive_reengage":
-                    state.last_reengage_sent_at = utcnow()
-                results.append((intent, text, True))
+            sent_iter = iter(sent)
 
-    # Print summary
-    print("=== Proactive Test Summary ===")
-    for intent, text, ok in results:
-        status = "OK" if ok else "FAIL"
-        print(f"[{status}] {intent}: {text[:120].replace('\n',' ')}")
+            results = []
+            record = results.append
+            pending = []
+            queue = pending.append
+            # one logical send time for the whole batch; record/queue are pre-bound for the loop
+            now = utcnow()
+            # walk outcomes in intent order so the summary keeps the requested order
+            for intent, outcome in zip(intents, generated):
+                if isinstance(outcome, BaseException):  # n8n failure
+                    record((intent, f"ERROR: {outcome}", False))
+                    continue
+                text, meta = outcome
+                sent_result = next(sent_iter)
+                if args.dry_run:
+                    record((intent, text, True))
+                    continue
+                meta_full = {"intent": intent, **meta}
+                if direct:
+                    if isinstance(sent_result, BaseException):
+                        record((intent, f"SEND ERROR: {sent_result}", False))
+                        continue
+                    queue(AssistantMessage(chat_id=chat_id, text=text, meta_json=meta_full))
+                    state.last_assistant_at = now
+                else:
+                    # enqueue for userbot outbox
+                    queue(
+                        ProactiveOutbox(chat_id=chat_id, intent=intent, text=text, meta_json=meta_full)
+                    )
+                # update intent timestamps similar to scheduler (both delivery paths)
+                ts_field = _INTENT_TS_FIELD.get(intent)
+                if ts_field:
+                    setattr(state, ts_field, now)
+                record((intent, text, True))
+            # single unit of work, flushed by session_scope's commit
+            session.add_all(pending)
 
-    if bot:
-        await bot.session.close()  # type: ignore
+        # Print summary in one write
+        lines = ["=== Proactive Test Summary ==="]
+        for intent, text, ok in results:
+            preview = text[:120].replace("\n", " ")
+            lines.append(f"[{'OK' if ok else 'FAIL'}] {intent}: {preview}")
+        sys.stdout.write("\n".join(lines) + "\n")
+    finally:
+        if bot is not None:
+            await bot.session.close()  # type: ignore
 
 
 if __name__ == "__main__":
+    # uvloop ships with uvicorn[standard] on Linux; fall back to the stock loop elsewhere
+    try:
+        import uvloop  # type: ignore
+
+        uvloop.install()
+    except ImportError:  # pragma: no cover
+        pass
     asyncio.run(main())
@@ -19,3 +19,8 @@ def test_antispam_over_window():
     assert is_allowed(last, now, 5)
     assert remaining_wait_seconds(last, now, 5) == 0
 
+
+def test_antispam_first_message():
+    now = utcnow()
+    assert is_allowed(None, now, 5)
+    assert remaining_wait_seconds(None, now, 5) == 0
@@ -0,0 +1,30 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+from app.utils.async_utils import concurrent_map
+
+
+async def _value(x: int, delay: float = 0) -> int:
+    await asyncio.sleep(delay)
+    if x < 0:
+        raise ValueError(x)
+    return x
+
+
+def test_concurrent_map_keeps_input_order():
+    res = asyncio.run(concurrent_map([_value(1, 0.02), _value(2), _value(3, 0.01)]))
+    assert res == [1, 2, 3]
+
+
+def test_concurrent_map_return_exceptions():
+    res = asyncio.run(concurrent_map([_value(1), _value(-1)], return_exceptions=True))
+    assert res[0] == 1
+    assert isinstance(res[1], ValueError)
+
+
+def test_concurrent_map_fails_fast():
+    with pytest.raises(ExceptionGroup):
+        asyncio.run(concurrent_map([_value(-1), _value(1, 5)]))
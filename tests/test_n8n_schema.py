@@ -2,20 +2,26 @@ from __future__ import annotations
 
 from datetime import datetime, timezone
 
+import pytest
+
 from app.bot.schemas.n8n_io import ChatInfo, Context, HistoryItem, Meta, N8nRequest, N8nResponse
 
 
-def test_n8n_request_response_models():
+@pytest.fixture(scope="module")
+def n8n_request() -> N8nRequest:
+    now = datetime.now(timezone.utc)
     history = [
-        HistoryItem(role="user", text="hi", created_at=datetime.now(timezone.utc)),
-        HistoryItem(role="assistant", text="hello", created_at=datetime.now(timezone.utc)),
+        HistoryItem(role="user", text="hi", created_at=now),
+        HistoryItem(role="assistant", text="hello", created_at=now),
     ]
     ctx = Context(history=history)
     chat = ChatInfo(chat_id=123, user_id=1, lang="ru", username="test")
-    req = N8nRequest(intent="reply", chat=chat, context=ctx, message=None, trace_id="abc")
+    return N8nRequest(intent="reply", chat=chat, context=ctx, message=None, trace_id="abc")
+
 
+def test_n8n_request_response_models(n8n_request):
     # Validate dump
-    payload = req.model_dump()
+    payload = n8n_request.model_dump()
     assert payload["intent"] == "reply"
     assert payload["chat"]["chat_id"] == 123
     assert len(payload["context"]["history"]) == 2